@@ -3,8 +3,7 @@ import params
 
 def get_matches_with_similar_amounts(matches):
     matches = calculate_amount_difference(matches)
-    matches = matches[matches['rel_amount_diff'] <= params.MAX_REL_AMOUNT_DIFF]
-    return calculate_gaussian_similarity(matches)
+    return matches[matches['rel_amount_diff'] <= params.MAX_REL_AMOUNT_DIFF]
 
 def calculate_amount_difference(matches):
     matches['rel_amount_diff'] = \
@@ -15,3 +14,14 @@ def calculate_gaussian_similarity(matches):
     matches = matches.copy()
     matches['amount_similarity'] = np.exp(-(matches['rel_amount_diff'] / params.GAUSSIAN_SIMILARITY_SCALE) ** 2)
     return matches
+
+def get_pairs_with_similar_amounts(inv_amounts, mov_amounts):
+    # Band join: for each invoice amount a, every movement amount m with |a - m| <= MAX_REL_AMOUNT_DIFF * a
+    mov_order = np.argsort(mov_amounts, kind='stable')
+    sorted_amounts = mov_amounts[mov_order]
+    start = np.searchsorted(sorted_amounts, inv_amounts * (1 - params.MAX_REL_AMOUNT_DIFF), side='left')
+    end = np.searchsorted(sorted_amounts, inv_amounts * (1 + params.MAX_REL_AMOUNT_DIFF), side='right')
+    counts = np.maximum(end - start, 0)
+    inv_pos = np.repeat(np.arange(len(inv_amounts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return inv_pos, mov_order[np.repeat(start, counts) + offsets]
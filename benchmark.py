@@ -0,0 +1,135 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from sklearn.model_selection import ParameterGrid
+from preprocessing import get_preprocessed_invoices_and_movements, format_rut
+from main import (get_mapped_invoices_and_movements, get_invoices_and_movements_with_groups,
+                  get_partition_candidates, match_without_counterparty_rut)
+from results import save_results
+from group_helpers import get_members
+from ilp import optimize
+from parallel import map_partitions
+from instrumentation import stage, start_run, set_output_rows
+import synthetic
+import params
+
+PATH = "Benchmark"
+GRID = {"n_invoices": [2000, 10000, 50000],
+        "MAX_GROUP_LEN": [3, 5],
+        "skew": [0.5, 1.5]}
+SEED = 0
+
+def main(grid=GRID):
+    results = []
+    for cfg in ParameterGrid(grid):
+        print("Benchmark", cfg)
+        # Every configuration runs in a fresh process so peak memory isn't carried over
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            stages = executor.submit(run_config, cfg).result()
+        results.extend({**cfg, **stage} for stage in stages)
+    results = pd.json_normalize(results, max_level=1)
+    results.to_csv(os.path.join(PATH, 'Benchmark.csv'), index=False)
+    print(results)
+    return results
+
+def run_config(cfg):
+    path = os.path.abspath(os.path.join(PATH, f"{cfg['n_invoices']} invoices, skew {cfg['skew']}"))
+    shutil.rmtree(path, ignore_errors=True)
+    invoices, movements, truth = synthetic.generate_invoices_and_movements(
+        n_invoices=cfg['n_invoices'], skew=cfg['skew'], seed=SEED)
+    synthetic.save_dataset(path, invoices, movements, truth)
+    os.chdir(path)
+    for name, value in cfg.items():
+        if name.isupper():
+            setattr(params, name, value)
+    return run_pipeline(truth)
+
+def run_pipeline(truth):
+    # Same stages as main.main, each one measured and scored against the truth
+    stages = []
+    start_run()
+    truth = format_rut(truth.rename(columns={'identity': 'rut', 'number': 'inv_number'}), ['rut'])
+    invoices, movements = measure_stage(stages, 'preprocessing', get_preprocessed_invoices_and_movements)
+    preprocessed = invoices, movements
+    invoices, movements, inv_num_map, mov_id_map = measure_stage(stages, 'inputs', get_mapped_invoices_and_movements,
+                                                                 invoices, movements)
+    inv_keys, mov_keys = get_truth_keys(truth, inv_num_map, mov_id_map)
+    set_unit_scores(stages[-1], inv_keys != b'', len(invoices) + len(movements))
+    invoices, movements = measure_stage(stages, 'groups', get_invoices_and_movements_with_groups, invoices, movements)
+    found = np.isin(inv_keys, get_row_keys(get_members(invoices, 'inv_member'))) & \
+            np.isin(mov_keys, get_row_keys(get_members(movements, 'mov_member')))
+    set_unit_scores(stages[-1], found, len(invoices) + len(movements))
+    stages[-1]['inv_groups'] = int(invoices['is_inv_group'].sum())
+    stages[-1]['mov_groups'] = int(movements['is_mov_group'].sum())
+    candidates = measure_stage(stages, 'candidates', map_partitions, get_partition_candidates, invoices, movements)
+    set_unit_scores(stages[-1], np.isin(inv_keys + mov_keys, get_candidate_keys(candidates)), len(candidates), True)
+    matches = measure_stage(stages, 'matches', optimize, candidates)
+    set_unit_scores(stages[-1], np.isin(inv_keys + mov_keys, get_candidate_keys(matches)), len(matches), True)
+    results = measure_stage(stages, 'results', save_results, matches, inv_num_map, mov_id_map, *preprocessed)
+    set_pair_scores(stages[-1], results, truth)
+    # Scored together with the matches above, as main returns them
+    without = measure_stage(stages, 'without_counterparty_rut', match_without_counterparty_rut, *preprocessed, results)
+    set_pair_scores(stages[-1], pd.concat([results, without]), truth)
+    return stages
+
+def measure_stage(stages, name, function, *args):
+    with stage(name, *args) as record:
+        result = function(*args)
+        set_output_rows(record, *(result if isinstance(result, tuple) else [result]))
+    stages.append(record)
+    return result
+
+def get_truth_keys(truth, inv_num_map, mov_id_map):
+    # A truth unit is one payment: an invoice with its split movements, or grouped invoices with their movement.
+    # Units are keyed by their sorted internal ids, units lost by preprocessing or too long get an empty key.
+    inv_index = pd.MultiIndex.from_frame(inv_num_map.astype({'rut': str}))
+    inv_ids = pd.Series(np.arange(len(inv_index)), index=inv_index).reindex(
+        pd.MultiIndex.from_arrays([truth['rut'], truth['inv_number']])).to_numpy()
+    mov_ids = pd.Series(np.arange(len(mov_id_map)), index=mov_id_map).reindex(truth['mov_id']).to_numpy()
+    is_split = truth.groupby('inv_number')['mov_id'].transform('size').to_numpy() > 1
+    units = np.where(is_split, truth['inv_number'].to_numpy(), -truth['mov_id'].to_numpy())
+    inv_keys, mov_keys = [], []
+    for positions in pd.Series(units).groupby(units).indices.values():
+        inv, mov = np.unique(inv_ids[positions]), np.unique(mov_ids[positions])
+        if np.isnan(inv).any() or np.isnan(mov).any() or max(len(inv), len(mov)) > params.MAX_GROUP_LEN:
+            inv_keys.append(b'')
+            mov_keys.append(b'')
+        else:
+            inv_keys.append(get_row_keys(pad_members(inv))[0])
+            mov_keys.append(get_row_keys(pad_members(mov))[0])
+    return np.array(inv_keys, dtype=object), np.array(mov_keys, dtype=object)
+
+def pad_members(ids):
+    members = np.full((1, params.MAX_GROUP_LEN), -1, dtype=np.int32)
+    members[0, :len(ids)] = ids
+    return members
+
+def get_row_keys(members):
+    # Member order doesn't matter, so rows are sorted before hashing them as bytes
+    members = np.ascontiguousarray(np.sort(members.astype(np.int32), axis=1))
+    return np.array([row.tobytes() for row in members], dtype=object)
+
+def get_candidate_keys(candidates):
+    return get_row_keys(get_members(candidates, 'inv_member')) + get_row_keys(get_members(candidates, 'mov_member'))
+
+def set_unit_scores(stage, found, rows, precision=False):
+    stage['rows'] = rows
+    stage['truth_units_found'] = int(found.sum())
+    stage['coverage'] = found.mean() if len(found) else np.nan
+    if precision:
+        stage['precision'] = found.sum() / rows if rows else np.nan
+
+def set_pair_scores(stage, results, truth):
+    pairs = results[['rut', 'inv_number', 'mov_id']].astype({'rut': str}).drop_duplicates()
+    correct = len(pairs.merge(truth[['rut', 'inv_number', 'mov_id']].astype({'rut': str}), on=['rut', 'inv_number', 'mov_id']))
+    stage['rows'] = len(pairs)
+    stage['truth_pairs_found'] = correct
+    stage['coverage'] = correct / len(truth) if len(truth) else np.nan
+    stage['precision'] = correct / len(pairs) if len(pairs) else np.nan
+
+if __name__ == '__main__':
+    pd.set_option('display.max_columns', None)
+    main()
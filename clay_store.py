@@ -0,0 +1,79 @@
+import sqlite3
+import asyncio
+import pandas as pd
+import fetch_clay
+import preprocess_clay
+
+PATH = "Clay.sqlite"
+COLUMNS = ['rut', 'inv_number', 'mov_key', 'account', 'fecha_match', 'mov_date', 'inv_date', 'mov_description',
+           'match_amount', 'mov_amount', 'counterparty_rut']
+
+def connect(path=PATH):
+    # Rows are clustered by their (rut, inv_number, mov_key) key, which also serves (rut, inv_number) lookups
+    con = sqlite3.connect(path)
+    con.execute("""CREATE TABLE IF NOT EXISTS matches (
+                       rut TEXT, inv_number TEXT, mov_key TEXT, account TEXT, fecha_match TEXT, mov_date TEXT, inv_date TEXT,
+                       mov_description TEXT, match_amount REAL, mov_amount REAL, counterparty_rut TEXT,
+                       PRIMARY KEY (rut, inv_number, mov_key)) WITHOUT ROWID""")
+    con.execute("""CREATE TABLE IF NOT EXISTS syncs (
+                       rut_empresa TEXT, account TEXT, last_fecha_match TEXT, PRIMARY KEY (rut_empresa, account))""")
+    return con
+
+def sync(accounts=None, base_url=fetch_clay.BASE_URL, path=PATH):
+    # Each account is pulled from its last synced fecha_match on, rows already stored under the same key are replaced
+    accounts = accounts if accounts is not None else fetch_clay.get_accounts()
+    con = connect(path)
+    try:
+        last_syncs = get_last_syncs(con)
+        results = asyncio.run(fetch_clay.fetch_matches(accounts, base_url, dates_from=last_syncs))
+        for (rut, num, _), items in zip(accounts, results):
+            if not items:
+                # Failed accounts are retried from the same date on the next sync
+                continue
+            rows = get_store_rows(items, num)
+            # One transaction per account, its sync date only moves forward with its rows
+            with con:
+                save_rows(con, rows)
+                if len(rows) and rows['fecha_match'].notna().any():
+                    con.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)",
+                                (rut, str(num), max(last_syncs.get((rut, str(num)), ''), rows['fecha_match'].max()[:10])))
+            print(f"Cuenta {num} de {rut}: {len(rows)} matches nuevos o actualizados")
+    finally:
+        con.close()
+
+def get_last_syncs(con):
+    return {(rut, account): last for rut, account, last in con.execute("SELECT * FROM syncs")}
+
+def get_store_rows(items, num):
+    df = preprocess_clay.preprocess_clay_items(pd.json_normalize(items, sep='_'))
+    df['account'] = str(num)
+    df['fecha_match'] = df['fecha_match'].astype('string') if 'fecha_match' in df else None
+    df['inv_number'] = df['inv_number'].astype(str)
+    df['mov_key'] = get_mov_keys(df)
+    return df[COLUMNS]
+
+def get_mov_keys(df):
+    # Movements are identified by their account, date, amount and description
+    return (df['account'] + '|' + df['mov_date'].astype(str) + '|' + df['mov_amount'].astype(str) + '|' +
+            df['mov_description'].astype(str))
+
+def save_rows(con, rows):
+    rows = rows.astype(object).where(rows.notna(), None)
+    con.executemany(f"INSERT OR REPLACE INTO matches ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                    rows.itertuples(index=False, name=None))
+
+def read_matches(ruts=None, path=PATH):
+    # Only the companies in ruts are read, all of them by default
+    query = f"SELECT {', '.join(COLUMNS)} FROM matches"
+    params = []
+    if ruts is not None:
+        params = [str(rut) for rut in ruts]
+        query += f" WHERE rut IN ({', '.join('?' * len(params))})"
+    con = sqlite3.connect(path)
+    try:
+        return pd.read_sql_query(query, con, params=params)
+    finally:
+        con.close()
+
+if __name__ == '__main__':
+    sync()
@@ -4,6 +4,8 @@ from preprocess_clay import get_clay_preprocessed_data
 from main import main
 from preprocessing import get_preprocessed_invoices_and_movements
 from sklearn.model_selection import ParameterGrid
+from stage_cache import get_stage_order_key
+from sinks import result_sink
 import params
 
 pd.set_option('display.max_columns', None)
@@ -44,8 +46,8 @@ def eval_matches(invoices, matches, clay):
     mismatch = merge[(merge['_merge']=='both') & ~(merge.index.isin(correct.index))]
     missing_clay = merge[merge['_merge']=='left_only']
     extra_matches    = merge[merge['_merge']=='right_only']
-    total_invs = invoices.groupby(["rut", "inv_number"]).ngroups
-    matched_invs = matches.groupby(["rut", "inv_number"]).ngroups
+    total_invs = invoices.groupby(["rut", "inv_number"], observed=True).ngroups
+    matched_invs = matches.groupby(["rut", "inv_number"], observed=True).ngroups
     print(f"Correct matches: {round(100*len(correct)/len(merge),2)}%")
     print(f"Incorrect matches: {round(100*len(mismatch)/len(merge),2)}%")
     print(f"Matches only in matches: {round(100*len(extra_matches)/len(merge),2)}%")
@@ -66,8 +68,8 @@ def calculate_score(invoices, matches, clay):
                     (merge['date_diff'] <= TOLERANCE)]
     correct = correct.sort_values(by='date_diff', ascending=False).drop(columns='_merge')
     mismatch = merge[(merge['_merge']=='both') & ~(merge.index.isin(correct.index))]
-    total_invs = invoices.groupby(["rut", "inv_number"]).ngroups
-    matched_invs = matches.groupby(["rut", "inv_number"]).ngroups
+    total_invs = invoices.groupby(["rut", "inv_number"], observed=True).ngroups
+    matched_invs = matches.groupby(["rut", "inv_number"], observed=True).ngroups
     print(f"Precision: {round(100*len(correct)/(len(correct)+len(mismatch)),2)}%")
     print(f"Coverage: {100*matched_invs/total_invs}%")
     precision = len(correct)/(len(correct)+len(mismatch))
@@ -77,7 +79,7 @@ def calculate_score(invoices, matches, clay):
 
 def tune_params():
     invoices, movements = get_preprocessed_invoices_and_movements()
-    clay = get_clay_preprocessed_data()
+    clay = get_clay_preprocessed_data(invoices['rut'].astype(str).unique())
     best_score = -1.0
     best_cfg   = None
     grid = {"MAX_GROUP_LEN": [5],
@@ -85,12 +87,11 @@ def tune_params():
             "MAX_MOV_DAYS_BEFORE_INV": [30],
             "MAX_MOV_DAYS_AFTER_INV": [170],
             "MAX_REL_AMOUNT_DIFF": [0.002],
-            "GAUSSIAN_SIMILARITY_SCALE": [0.0004, 0.00035],
-            "WINDOW_SIZE": [3],
-            "AMOUNT_BIN": [100000]}
+            "GAUSSIAN_SIMILARITY_SCALE": [0.0004, 0.00035]}
     
     counter = 0
-    pg = ParameterGrid(grid)
+    pg = sorted(ParameterGrid(grid), key=get_stage_order_key)
+    cache = {}
 
     for cfg in pg:
         counter += 1
@@ -98,7 +99,7 @@ def tune_params():
             setattr(params, name, val)
 
 
-        matches = main()
+        matches = main(cache)
         invoices, movements, matches, clay = fix_column_types(invoices, movements, matches, clay)
         score = calculate_score(invoices, matches, clay)
         print(f"Config {counter}/{len(pg)}", "Score:", score, "Best score:", best_score)
@@ -109,13 +110,13 @@ def tune_params():
             best_cfg = pd.DataFrame([best_cfg]).to_csv('best_params.csv', index=False) 
     
 def save_comp(merge, wrong_matches, missing_matches, missing_clay, all_invs, all_movs):
-    with pd.ExcelWriter('Compare.xlsx') as writer:
-        merge.to_excel(writer, sheet_name="Matches exitosos", index=False)
-        wrong_matches.to_excel(writer, sheet_name="Matches distintos", index=False)
-        missing_matches.to_excel(writer, sheet_name="Matches faltantes en Clay", index=False)
-        missing_clay.to_excel(writer, sheet_name="Matches de Clay pendientes", index=False)
-        all_invs.to_excel(writer, sheet_name="Todas las facts", index=False)
-        all_movs.to_excel(writer, sheet_name="Todos los movs", index=False)
+    with result_sink('Compare') as write:
+        write("Matches exitosos", merge)
+        write("Matches distintos", wrong_matches)
+        write("Matches faltantes en Clay", missing_matches)
+        write("Matches de Clay pendientes", missing_clay)
+        write("Todas las facts", all_invs)
+        write("Todos los movs", all_movs)
 
 if __name__ == "__main__":
     # invoices, movements = get_preprocessed_invoices_and_movements()
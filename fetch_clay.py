@@ -1,7 +1,23 @@
-import requests
-from time import sleep
+import os
+import glob
+import json
+import random
+import asyncio
+from datetime import date
+from time import monotonic
+import aiohttp
 import pandas as pd
 
+BASE_URL = os.environ.get('CLAY_BASE_URL', "https://api.clay.cl/v1")
+PATH = "Clay Pages"  # one checkpoint per fetched page, an interrupted pull resumes from them
+PAGE_SIZE = 200
+REQUESTS_PER_SECOND = 0.5  # per token
+MAX_CONNECTIONS = 8
+MAX_RETRIES = 5
+BACKOFF = 2  # seconds, doubled on every retry
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+DATE_FROM = '2020-01-01'
+
 ruts = ['76134123',
         '76211029',
         '76285545',
@@ -18,46 +34,113 @@ acc_nums = [[11481052701, 1481052700],
         [27900031110, 34770806293],
         [76987299]]
 
-def get_all_matches(rut, num, key):
-  result = query(rut,num,key,0)
+def main(accounts, base_url=BASE_URL, path=PATH):
+  results = asyncio.run(fetch_matches(accounts, base_url, path))
+  items = [item for matches in results if matches for item in matches]
+  df = pd.json_normalize(items, sep='_')
+  #items["folio", descr, "emisor_obligacion.rut+dv", "receptor_obligacion.rut+dv", monto_original_movimiento, monto_match, ]
+  df.to_csv("Clay.csv", index=False)
+  return df
+
+def get_accounts():
+  return [(ruts[i], num, api_keys[i]) for i in range(len(ruts)) for num in acc_nums[i]]
+
+async def fetch_matches(accounts, base_url=BASE_URL, path=PATH, dates_from=None):
+  # Accounts and pages run concurrently on one pooled session, each token has its own rate limiter.
+  # dates_from maps (rut, account number) to the first fecha_match to pull, DATE_FROM by default.
+  # Returns the matches of each account, None for accounts that couldn't be pulled completely.
+  dates_from = dates_from or {}
+  os.makedirs(path, exist_ok=True)
+  limiters = {key: create_rate_limiter() for _, _, key in accounts}
+  async with aiohttp.ClientSession(base_url=base_url.rstrip('/') + '/',
+                                   connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS)) as session:
+    return await asyncio.gather(*[get_all_matches(session, limiters[key], rut, num, key, path,
+                                                  dates_from.get((rut, str(num)), DATE_FROM))
+                                  for rut, num, key in accounts])
+
+async def get_all_matches(session, limiter, rut, num, key, path, date_from=DATE_FROM):
+  # Checkpoints are keyed on the pull's start date, its end date is the one recorded by its first page,
+  # so a pull resumed on a later day asks for the same pages. They are removed once the pull is complete.
+  prefix = os.path.join(path, f"{rut}_{num}_{date_from}")
+  date_to = get_checkpoint_date_to(prefix) or date.today().isoformat()
+  result = await get_page(session, limiter, rut, num, key, 0, prefix, date_from, date_to)
   if not result:
     return None
   total_records = result["data"]["records"]["total_records"]
-  items = result["data"]["items"]
-  offset = 200
-  while offset < total_records:
-    sleep(2)
-    result = query(rut,num,key,offset)
-    items.extend(result["data"]["items"])
-    offset += 200
-  return items
-
-def query(rut,num,key,offset):
-  url = f"https://api.clay.cl/v1/cuentas_bancarias/matches/?abono=true&orden=Asc&numero_cuenta={num}&rut_empresa={rut}&limit=200&offset={offset}&fecha_match_desde=2020-01-01&fecha_match_hasta=2025-04-24&fecha_desde=2020-01-01&fecha_hasta=2025-04-24"
+  pages = await asyncio.gather(*[get_page(session, limiter, rut, num, key, offset, prefix, date_from, date_to)
+                                 for offset in range(PAGE_SIZE, total_records, PAGE_SIZE)])
+  if not all(pages):
+    print(f"Cuenta {num} de {rut} incompleta, se retoma desde los checkpoints en la siguiente ejecución")
+    return None
+  remove_checkpoints(prefix)
+  return [item for page in [result] + pages for item in page["data"]["items"]]
+
+async def get_page(session, limiter, rut, num, key, offset, prefix, date_from, date_to):
+  checkpoint = f"{prefix}_{offset}.json"
+  if os.path.exists(checkpoint):
+    with open(checkpoint) as file:
+      return json.load(file)['result']
+  result = await query(session, limiter, rut, num, key, offset, date_from, date_to)
+  if result:
+    # Written to a temporary file first so an interruption never leaves a partial checkpoint
+    with open(checkpoint + '.tmp', 'w') as file:
+      json.dump({'date_to': date_to, 'result': result}, file)
+    os.replace(checkpoint + '.tmp', checkpoint)
+  return result
+
+def get_checkpoint_date_to(prefix):
+  checkpoint = f"{prefix}_0.json"
+  if not os.path.exists(checkpoint):
+    return None
+  with open(checkpoint) as file:
+    return json.load(file)['date_to']
+
+def remove_checkpoints(prefix):
+  for file in glob.glob(glob.escape(prefix) + '_*.json'):
+    os.remove(file)
+
+async def query(session, limiter, rut, num, key, offset, date_from, date_to):
+  # Movement dates keep the full range, only the match date moves forward on delta syncs
+  params = {'abono': 'true', 'orden': 'Asc', 'numero_cuenta': num, 'rut_empresa': rut, 'limit': PAGE_SIZE, 'offset': offset,
+            'fecha_match_desde': date_from, 'fecha_match_hasta': date_to, 'fecha_desde': DATE_FROM, 'fecha_hasta': date_to}
   headers = {
     'accept': 'application/json',
     'Token': key
   }
-  response = requests.get(url, headers=headers)
-
-  if response.status_code == 200:
-      return response.json()
-
-  else:
-      print(f"Request failed with status code {response.status_code}: {response.text}")
-      return None
-
-items = []
-for i in range(len(ruts)):
-  rut = ruts[i]
-  nums = acc_nums[i]
-  key = api_keys[i]
-  for num in nums:
-    matches = get_all_matches(rut,num,key)
-    if matches:
-      items.extend(matches)
-  sleep(2)
-
-df = df = pd.json_normalize(items, sep='_')
-#items["folio", descr, "emisor_obligacion.rut+dv", "receptor_obligacion.rut+dv", monto_original_movimiento, monto_match, ]
-df.to_csv("Clay.csv", index=False)
\ No newline at end of file
+  for attempt in range(MAX_RETRIES + 1):
+    await wait_for_turn(limiter)
+    try:
+      async with session.get("cuentas_bancarias/matches/", params=params, headers=headers) as response:
+        if response.status == 200:
+          return await response.json()
+        text = await response.text()
+        retry_after = response.headers.get('Retry-After')
+        if response.status not in RETRY_STATUSES:
+          print(f"Request failed with status code {response.status}: {text}")
+          return None
+        error = f"status code {response.status}"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      retry_after, error = None, repr(e)
+    if attempt < MAX_RETRIES:
+      await asyncio.sleep(get_backoff(attempt, retry_after))
+  print(f"Request failed after {MAX_RETRIES} retries ({error}): {rut} {num} offset {offset}")
+  return None
+
+def get_backoff(attempt, retry_after=None):
+  if retry_after is not None and retry_after.isdigit():
+    return float(retry_after)
+  return BACKOFF * 2 ** attempt * (1 + random.random() / 2)
+
+def create_rate_limiter(rate=REQUESTS_PER_SECOND):
+  return {'lock': asyncio.Lock(), 'interval': 1 / rate, 'next': 0.0}
+
+async def wait_for_turn(limiter):
+  # Requests of a token are spaced at least interval seconds apart
+  async with limiter['lock']:
+    now = monotonic()
+    delay = max(0.0, limiter['next'] - now)
+    limiter['next'] = max(now, limiter['next']) + limiter['interval']
+  await asyncio.sleep(delay)
+
+if __name__ == "__main__":
+  main(get_accounts())
@@ -1,4 +1,9 @@
+import pandas as pd
 import numpy as np
+import itertools
+import params
+
+GROUP_ANCHOR_CHUNK = 65536  # anchors enumerated per chunk, bounds the temporary arrays
 
 def get_invoices_with_rut_associated_movements(invoices, movements):
     return invoices[invoices['counterparty_rut'].isin(movements['counterparty_rut'])]
@@ -17,20 +22,175 @@ def create_movement_group(movements):
     group['mov_amount'] = sum(map(lambda x: x['mov_amount'], movements))
     group['is_mov_group'] = True
     group['mov_group_len'] = len(movements)
-    group['first_mov_date'] = movements[0]['mov_date']
-    group['last_mov_date'] = movements[-1]['mov_date']
+    group['first_mov_date'] = min(map(lambda x: x['first_mov_date'], movements))
+    group['last_mov_date'] = max(map(lambda x: x['last_mov_date'], movements))
     group['mov_group_ids'] = tuple((map(lambda x: x['mov_id'], movements)))
     group['mov_id'] = np.nan
     group['mov_description'] = np.nan
     return group
 
-def create_invoice_group(invoices):
-    group = invoices[0].copy()
-    group['inv_amount'] = sum(map(lambda x: x['inv_amount'], invoices))
-    group['is_inv_group'] = True
-    group['inv_group_len'] = len(invoices)
-    group['first_inv_date'] = invoices[0]['inv_date']
-    group['last_inv_date'] = invoices[-1]['inv_date']
-    group['inv_group_numbers'] = tuple(map(lambda x: x['inv_number'], invoices))
-    group['inv_number'] = np.nan
-    return group
+def get_partition_targets(df, amount_column):
+    if df is None or not params.TARGET_DRIVEN_GROUPS:
+        return None
+    return {key: np.sort(amounts.to_numpy()) for key, amounts in df.groupby(['rut', 'counterparty_rut'], observed=True)[amount_column]}
+
+def invoice_group_target_range(amount):
+    # |inv - mov| <= MAX_REL_AMOUNT_DIFF * inv, with inv being the group sum
+    return amount * (1 - params.MAX_REL_AMOUNT_DIFF), amount * (1 + params.MAX_REL_AMOUNT_DIFF)
+
+def movement_group_target_range(amount):
+    # |inv - mov| <= MAX_REL_AMOUNT_DIFF * inv, with mov being the group sum
+    return amount / (1 + params.MAX_REL_AMOUNT_DIFF), amount / (1 - params.MAX_REL_AMOUNT_DIFF)
+
+def has_target_in_range(targets, low, high):
+    i = np.searchsorted(targets, low, side='left')
+    found = i < len(targets)
+    found[found] = targets[i[found]] <= high[found]
+    return found
+
+def get_group_table(df, amount_column, day_column, id_column, targets=None, target_range=None):
+    # day_column holds int32 day ordinals
+    tables = []
+    for key, part in df.groupby(['rut', 'counterparty_rut'], observed=True):
+        part_targets = None if targets is None else targets.get(key)
+        if targets is not None and (part_targets is None or not len(part_targets)):
+            continue
+        part = part.sort_values(by=day_column, ascending=True, kind='stable')
+        amounts = part[amount_column].to_numpy(dtype=np.float64)
+        days = part[day_column].to_numpy(dtype=np.int32)
+        ids = part[id_column].to_numpy()
+        if part_targets is None:
+            subgroups = iter_subgroups(days)
+        else:
+            subgroups = iter_target_subgroups(days, amounts, part_targets, target_range)
+        for positions in subgroups:
+            tables.append(create_group_table(key, positions, amounts, days, ids))
+    return concat_group_tables(tables)
+
+def iter_subgroups(days):
+    # Rows are sorted by date, so every group is enumerated exactly once from its earliest member (the anchor):
+    # the anchor plus an offset pattern within its next MAX_GROUP_LEN - 1 rows, kept if it spans at most
+    # MAX_GROUP_DATE_DIFF days. Position matrices are yielded in (anchor, members) order, a chunk of anchors at a time.
+    patterns = get_offset_patterns()
+    spans = patterns.max(axis=1)
+    for start in range(0, len(days), GROUP_ANCHOR_CHUNK):
+        anchors = np.arange(start, min(start + GROUP_ANCHOR_CHUNK, len(days)), dtype=np.int32)
+        last = anchors[:, None] + spans
+        valid = last < len(days)
+        valid[valid] = (days[last[valid]] - days[np.nonzero(valid)[0] + start]) <= params.MAX_GROUP_DATE_DIFF
+        anchor_index, pattern_index = np.nonzero(valid)
+        offsets = patterns[pattern_index]
+        yield np.where(offsets >= 0, anchors[anchor_index, None] + offsets, -1)
+
+def iter_target_subgroups(days, amounts, targets, target_range):
+    # Target-driven iter_subgroups, same groups with a target in range and in the same order. Groups grow
+    # one member at a time from their anchor, and as amounts are positive a running sum whose range starts
+    # above every target is never extended (nor is an anchor that is already above them all).
+    for start in range(0, len(days), GROUP_ANCHOR_CHUNK):
+        anchors = np.arange(start, min(start + GROUP_ANCHOR_CHUNK, len(days)), dtype=np.int32)
+        anchors = anchors[target_range(amounts[anchors])[0] <= targets[-1]]
+        positions, sums = anchors[:, None], amounts[anchors]
+        groups = []
+        while positions.shape[1] < params.MAX_GROUP_LEN and len(positions):
+            positions, sums = extend_subgroups(positions, sums, days, amounts)
+            low, high = target_range(sums)
+            alive = low <= targets[-1]
+            positions, sums = positions[alive], sums[alive]
+            found = positions[has_target_in_range(targets, low[alive], high[alive])]
+            groups.append(np.pad(found, ((0, 0), (0, params.MAX_GROUP_LEN - found.shape[1])), constant_values=-1))
+        groups = np.concatenate(groups) if groups else np.empty((0, params.MAX_GROUP_LEN), dtype=np.int32)
+        yield groups[np.lexsort(groups.T[::-1])]
+
+def extend_subgroups(positions, sums, days, amounts):
+    # Every group plus each later row within MAX_GROUP_LEN rows and MAX_GROUP_DATE_DIFF days of its anchor
+    anchor, last = positions[:, 0], positions[:, -1]
+    counts = np.maximum(0, np.minimum(anchor + params.MAX_GROUP_LEN, len(days)) - last - 1)
+    rows = np.repeat(np.arange(len(positions)), counts)
+    following = last[rows] + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    valid = days[following] - days[anchor[rows]] <= params.MAX_GROUP_DATE_DIFF
+    rows, following = rows[valid], following[valid].astype(np.int32)
+    return np.column_stack([positions[rows], following]), sums[rows] + amounts[following]
+
+def get_offset_patterns():
+    # Offsets from the anchor of every group shape, in lexicographic order, padded with -1
+    shapes = sorted((0,) + comb for length in range(1, params.MAX_GROUP_LEN)
+                    for comb in itertools.combinations(range(1, params.MAX_GROUP_LEN), length))
+    patterns = np.full((len(shapes), params.MAX_GROUP_LEN), -1, dtype=np.int32)
+    for i, shape in enumerate(shapes):
+        patterns[i, :len(shape)] = shape
+    return patterns
+
+def get_group_amounts(positions, amounts):
+    valid = positions >= 0
+    return np.where(valid, amounts[np.where(valid, positions, 0)], 0).sum(axis=1)
+
+def create_group_table(key, positions, amounts, days, ids):
+    valid = positions >= 0
+    lengths = valid.sum(axis=1)
+    safe_positions = np.where(valid, positions, 0)
+    members = np.where(valid, ids[safe_positions], -1).astype(np.int32)
+    return {
+        'rut': np.repeat(np.array([key[0]], dtype=object), len(positions)),
+        'counterparty_rut': np.repeat(np.array([key[1]], dtype=object), len(positions)),
+        'amount': get_group_amounts(positions, amounts),
+        'first_date': np.where(valid, days[safe_positions], np.iinfo(np.int32).max).min(axis=1).astype(np.int32),
+        'last_date': np.where(valid, days[safe_positions], np.iinfo(np.int32).min).max(axis=1).astype(np.int32),
+        'length': lengths,
+        'members': members,
+    }
+
+def concat_group_tables(tables):
+    if not tables:
+        return create_group_table(('', ''), np.empty((0, params.MAX_GROUP_LEN), dtype=np.int32), np.empty(0),
+                                  np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32))
+    return {column: np.concatenate([table[column] for table in tables]) for column in tables[0]}
+
+def member_columns(prefix):
+    return [f'{prefix}_{i}' for i in range(params.MAX_GROUP_LEN)]
+
+def get_members(df, prefix):
+    return df[member_columns(prefix)].to_numpy(dtype=np.int32)
+
+def add_single_members(df, id_column, prefix):
+    members = np.full((len(df), params.MAX_GROUP_LEN), -1, dtype=np.int32)
+    members[:, 0] = df[id_column].to_numpy()
+    df[member_columns(prefix)] = members
+    return df
+
+def create_invoice_groups(table):
+    groups = pd.DataFrame({
+        'rut': table['rut'],
+        'counterparty_rut': table['counterparty_rut'],
+        'inv_amount': table['amount'],
+        'is_inv_group': True,
+        'inv_group_len': table['length'],
+        'first_inv_date': table['first_date'],
+        'last_inv_date': table['last_date'],
+    })
+    groups[member_columns('inv_member')] = table['members']
+    return groups
+
+def create_movement_groups(table):
+    groups = pd.DataFrame({
+        'rut': table['rut'],
+        'counterparty_rut': table['counterparty_rut'],
+        'mov_amount': table['amount'],
+        'is_mov_group': True,
+        'mov_group_len': table['length'],
+        'first_mov_date': table['first_date'],
+        'last_mov_date': table['last_date'],
+    })
+    groups[member_columns('mov_member')] = table['members']
+    return groups
+
+def map_invoices(invoices):
+    # Dense int32 ids in order of appearance, inv_num_map holds the (rut, inv_number) of each id
+    ids, inv_num_map = pd.MultiIndex.from_frame(invoices[['rut', 'inv_number']]).factorize()
+    return invoices.assign(inv_number=ids.astype(np.int32)), inv_num_map.to_frame(index=False, name=['rut', 'inv_number'])
+
+def map_movements(movements):
+    ids, mov_id_map = pd.factorize(movements['mov_id'])
+    return movements.assign(mov_id=ids.astype(np.int32)), mov_id_map
+
+def gather_rows(df, positions):
+    return {column: df[column].to_numpy()[positions] for column in df.columns}
@@ -1,47 +1,179 @@
+import os
+import numpy as np
 import pandas as pd
-from pulp import LpProblem, LpMaximize, LpVariable, lpSum, LpBinary, PULP_CBC_CMD
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import milp, LinearConstraint, Bounds
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+from group_helpers import get_members, member_columns
+from amount_similarity import calculate_gaussian_similarity
+from instrumentation import set_stats
 import params
 
+TIME_LIMIT = 90  # seconds, split across components by size
+MIN_TIME_LIMIT = 1
+GAP_REL = 0.01  # stop when within this fraction of optimum
+BATCH_SIZE = 5000  # candidates per solver call, components are never split
+WORKERS = os.cpu_count()
+
 def optimize(matches):
     matches = calculate_scores(matches)
+    if params.OPTIMIZER == 'greedy':
+        return solve_greedy(matches)
     matches = solve_ilp(matches)
     return matches
 
 def calculate_scores(matches):
-    matches['date_score'] = matches['date_diff'].apply(
-        lambda x: 1 - x / 180
-    )
+    matches = calculate_gaussian_similarity(matches)
+    matches['date_score'] = 1 - matches['date_diff'] / 180
     matches['score'] = (matches['amount_similarity'] * matches['date_score'])
-    return matches[['inv_group_numbers', 'mov_group_ids', 'score', 'amount_similarity', 'date_score']]
+    return matches[member_columns('inv_member') + member_columns('mov_member') +
+                   ['score', 'amount_similarity', 'date_score']]
+
+def solve_greedy(matches):
+    scores = matches['score'].to_numpy(dtype=np.float64)
+    rows, ids = get_usage(matches)
+    selected = get_greedy_selection(scores, rows, ids)
+    set_stats(solver={'optimizer': 'greedy', 'variables': len(scores), 'selected': len(selected),
+                      'objective': scores[selected].sum()})
+    return matches.iloc[selected].copy()
 
 def solve_ilp(matches):
-    prob = LpProblem("InvoiceMovementMatching", LpMaximize)
-    x = {idx: LpVariable(f"x_{idx}", cat=LpBinary) for idx in matches.index}
+    scores = matches['score'].to_numpy(dtype=np.float64)
+    rows, ids = get_usage(matches)
+    labels = get_components(len(matches), rows, ids)
+    selected, pending = solve_trivial_components(scores, labels, rows, ids)
+    batches = get_component_batches(labels, pending)
+    batch_selected, batch_stats = solve_batches(batches, scores, rows, ids)
+    selected.extend(batch_selected)
+    set_stats(solver=get_solver_stats(batch_stats, len(selected) - len(batch_selected), scores[selected].sum()))
+    return matches.iloc[np.sort(np.asarray(selected, dtype=np.int64))].copy()
 
-    prob += lpSum(matches.loc[idx, 'score'] * x[idx] for idx in matches.index)
+def get_usage(matches):
+    # (candidate, id) pairs with invoice and movement ids in one dense id space
+    inv_rows, inv_ids = explode_members(get_members(matches, 'inv_member'))
+    mov_rows, mov_ids = explode_members(get_members(matches, 'mov_member'))
+    n_inv = inv_ids.max() + 1 if len(inv_ids) else 0
+    return np.concatenate([inv_rows, mov_rows]), np.concatenate([inv_ids, n_inv + mov_ids])
 
-    inv_id_usage = defaultdict(list)
-    mov_id_usage = defaultdict(list)
+def explode_members(members):
+    rows, positions = np.nonzero(members >= 0)
+    return rows, np.unique(members[rows, positions], return_inverse=True)[1].reshape(-1)
 
-    for idx, row in matches.iterrows():
-        for inv_id in row['inv_group_numbers']:
-            inv_id_usage[inv_id].append(x[idx])
-        for mov_id in row['mov_group_ids']:
-            mov_id_usage[mov_id].append(x[idx])
+def get_greedy_selection(scores, rows, ids):
+    # Mutual-best rounds: a candidate is taken when it ranks first on every id it uses,
+    # which selects the same set as taking candidates one by one in score order.
+    n_candidates = len(scores)
+    n_ids = ids.max() + 1 if len(ids) else 0
+    rank = np.empty(n_candidates, dtype=np.int64)
+    rank[np.argsort(-scores, kind='stable')] = np.arange(n_candidates)
+    usage_count = np.bincount(rows, minlength=n_candidates)
+    active = scores > 0
+    selected = np.zeros(n_candidates, dtype=bool)
+    while active.any():
+        live = active[rows]
+        live_rows, live_ids = rows[live], ids[live]
+        best = np.full(n_ids, n_candidates, dtype=np.int64)
+        np.minimum.at(best, live_ids, rank[live_rows])
+        wins = np.bincount(live_rows, weights=best[live_ids] == rank[live_rows], minlength=n_candidates)
+        accepted = active & (wins == usage_count)
+        selected |= accepted
+        taken = np.zeros(n_ids, dtype=bool)
+        taken[ids[accepted[rows]]] = True
+        active[rows[taken[ids]]] = False
+    return np.flatnonzero(selected)
 
-    for inv_id, vars in inv_id_usage.items():
-        prob += lpSum(vars) <= 1
+def get_components(n_candidates, rows, ids):
+    # Candidates and ids are the nodes of one graph, two candidates share a component
+    # only if they are linked through some invoice or movement id.
+    n_nodes = n_candidates + (ids.max() + 1 if len(ids) else 0)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, n_candidates + ids)), shape=(n_nodes, n_nodes))
+    _, labels = connected_components(graph, directed=False)
+    return labels[:n_candidates]
 
-    for mov_id, vars in mov_id_usage.items():
-        prob += lpSum(vars) <= 1
+def solve_trivial_components(scores, labels, rows, ids):
+    # A component whose candidates all share one id admits a single candidate, the best one.
+    sizes = np.bincount(labels)
+    shared = np.zeros(len(sizes), dtype=bool)
+    if len(ids):
+        usage = np.bincount(ids)
+        shared[labels[rows][usage[ids] == sizes[labels[rows]]]] = True
+    order = np.lexsort((-scores, labels))
+    first = order[np.r_[True, labels[order][1:] != labels[order][:-1]]] if len(order) else order
+    best = first[shared[labels[first]] & (scores[first] > 0)]
+    return best.tolist(), ~shared
 
-    solver = PULP_CBC_CMD(
-        msg=False,
-        timeLimit=90,  # seconds
-        gapRel=0.01        # stop when within this fraction of optimum
-    )
-    prob.solve(solver)
+def get_component_batches(labels, pending):
+    # Components are packed largest first into batches of about BATCH_SIZE candidates.
+    sizes = np.bincount(labels)
+    batch_of_component = np.full(len(sizes), -1, dtype=np.int64)
+    batch_sizes, batch_size = [], 0
+    for component in np.flatnonzero(pending)[np.argsort(-sizes[pending], kind='stable')]:
+        if batch_size and batch_size + sizes[component] > BATCH_SIZE:
+            batch_sizes.append(batch_size)
+            batch_size = 0
+        batch_of_component[component] = len(batch_sizes)
+        batch_size += sizes[component]
+    if batch_size:
+        batch_sizes.append(batch_size)
+    return batch_of_component[labels], np.array(batch_sizes)
 
-    selected = matches.loc[[idx for idx in matches.index if x[idx].varValue == 1.0]].copy()
-    return selected
+def solve_batches(batches, scores, rows, ids):
+    batch_of_candidate, batch_sizes = batches
+    if not len(batch_sizes):
+        return [], []
+    candidates = split_by_batch(np.arange(len(scores)), batch_of_candidate, len(batch_sizes))
+    local = np.empty(len(scores), dtype=np.int64)
+    for batch_rows in candidates:
+        local[batch_rows] = np.arange(len(batch_rows))
+    usages = split_by_batch(np.arange(len(rows)), batch_of_candidate[rows], len(batch_sizes))
+    time_limits = np.maximum(MIN_TIME_LIMIT, TIME_LIMIT * batch_sizes / batch_sizes.sum())
+    tasks = [(scores[batch_rows], local[rows[usage]], ids[usage], time_limit)
+             for batch_rows, usage, time_limit in zip(candidates, usages, time_limits)]
+    if len(tasks) == 1 or WORKERS == 1:
+        results = [solve_batch(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+            results = list(executor.map(solve_batch, *zip(*tasks)))
+    selected = [i for batch_rows, (result, _) in zip(candidates, results) for i in batch_rows[result]]
+    return selected, [stats for _, stats in results]
+
+def get_solver_stats(batch_stats, trivial_selected, objective):
+    statuses = {}
+    for stats in batch_stats:
+        statuses[stats['status']] = statuses.get(stats['status'], 0) + 1
+    gaps = [stats['gap'] for stats in batch_stats if stats['gap'] is not None]
+    return {'optimizer': 'ilp', 'trivial_selected': trivial_selected, 'batches': len(batch_stats),
+            'variables': sum(stats['variables'] for stats in batch_stats),
+            'constraints': sum(stats['constraints'] for stats in batch_stats),
+            'max_gap': max(gaps) if gaps else None, 'statuses': statuses,
+            'greedy_batches': sum(stats['solution'] == 'greedy' for stats in batch_stats),
+            'objective': objective}
+
+def split_by_batch(values, batch_of_value, n_batches):
+    order = np.argsort(batch_of_value, kind='stable')
+    bounds = np.searchsorted(batch_of_value[order], np.arange(n_batches + 1))
+    return [values[order[bounds[i]:bounds[i + 1]]] for i in range(n_batches)]
+
+def solve_batch(scores, rows, ids, time_limit):
+    # The greedy solution is the incumbent: milp can't take a MIP start, so its value is
+    # added as an objective cutoff and it is kept whenever the solver doesn't improve on it.
+    ids = np.unique(ids, return_inverse=True)[1].reshape(-1)
+    greedy = get_greedy_selection(scores, rows, ids)
+    greedy_score = scores[greedy].sum()
+    usage = csr_matrix((np.ones(len(rows)), (ids, rows)), shape=(ids.max() + 1, len(scores)))
+    constraints = [LinearConstraint(usage, -np.inf, 1)]
+    if len(greedy):
+        constraints.append(LinearConstraint(csr_matrix(scores.reshape(1, -1)), greedy_score - 1e-6, np.inf))
+    result = milp(
+        -scores,
+        integrality=np.ones(len(scores)),
+        bounds=Bounds(0, 1),
+        constraints=constraints,
+        options={'time_limit': time_limit, 'mip_rel_gap': GAP_REL, 'disp': False},
+    )
+    stats = {'variables': len(scores), 'constraints': sum(c.A.shape[0] for c in constraints),
+             'status': result.message, 'gap': result.get('mip_gap'), 'solution': 'milp'}
+    if result.x is None or -result.fun <= greedy_score:
+        return greedy, dict(stats, solution='greedy')
+    return np.flatnonzero(result.x > 0.5), stats
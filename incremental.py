@@ -0,0 +1,113 @@
+import os
+import pandas as pd
+import numpy as np
+from time import time
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from preprocessing import get_preprocessed_invoices_and_movements
+from main import match_with_counterparty_rut
+import params
+
+PATH = "Incremental"
+PARTITION = ['rut', 'counterparty_rut']
+INVOICE_ROW_COLUMNS = ['rut', 'counterparty_rut', 'inv_number', 'inv_date', 'inv_amount']
+MOVEMENT_ROW_COLUMNS = ['rut', 'counterparty_rut', 'mov_id', 'mov_date', 'mov_amount', 'mov_description']
+
+def main():
+    start = time()
+    invoices, movements = get_preprocessed_invoices_and_movements()
+    matches = match_incrementally(invoices, movements)
+    print("Tiempo total", time()-start)
+    return matches
+
+def match_incrementally(invoices, movements):
+    inv_rows = get_row_hashes(invoices, INVOICE_ROW_COLUMNS, 'inv_date')
+    mov_rows = get_row_hashes(movements, MOVEMENT_ROW_COLUMNS, 'mov_date')
+    state = read_state()
+    if state is None:
+        matches = match_with_counterparty_rut(invoices, movements)
+        save_state(matches, inv_rows, mov_rows)
+        return matches
+    prev_matches, prev_inv_rows, prev_mov_rows = state
+    cutoffs = get_partition_cutoffs(inv_rows, mov_rows, prev_inv_rows, prev_mov_rows)
+    print(f"Particiones a conciliar: {len(cutoffs)}")
+    kept, dropped = get_kept_and_dropped_matches(prev_matches, cutoffs)
+    invoices = get_pending_rows(invoices, kept, dropped, cutoffs, ['rut', 'inv_number'], 'inv_date')
+    movements = get_pending_rows(movements, kept, dropped, cutoffs, ['mov_id'], 'mov_date')
+    new_matches = match_with_counterparty_rut(invoices, movements) if len(invoices) and len(movements) else None
+    matches = pd.concat([kept, new_matches], ignore_index=True)
+    save_state(matches, inv_rows, mov_rows)
+    return matches
+
+def get_row_hashes(df, columns, date_column):
+    rows = df[PARTITION].copy()
+    rows['date'] = df[date_column]
+    rows['row_hash'] = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    return rows.reset_index(drop=True)
+
+def get_partition_cutoffs(inv_rows, mov_rows, prev_inv_rows, prev_mov_rows):
+    # A new, changed or removed row can only move matches within MAX_MOV_DAYS_AFTER_INV of it,
+    # so each touched partition is re-run from its earliest changed date minus that window.
+    changed = pd.concat([
+        get_changed_rows(inv_rows, prev_inv_rows), get_changed_rows(prev_inv_rows, inv_rows),
+        get_changed_rows(mov_rows, prev_mov_rows), get_changed_rows(prev_mov_rows, mov_rows),
+    ])
+    cutoffs = changed.groupby(PARTITION, observed=True)['date'].min().reset_index()
+    cutoffs['cutoff'] = cutoffs['date'] - pd.Timedelta(days=params.MAX_MOV_DAYS_AFTER_INV)
+    return cutoffs[PARTITION + ['cutoff']]
+
+def get_changed_rows(rows, other_rows):
+    changed = rows[~rows['row_hash'].isin(other_rows['row_hash'])]
+    return changed[PARTITION + ['date']].astype({column: str for column in PARTITION})
+
+def get_kept_and_dropped_matches(matches, cutoffs):
+    # Matches are kept as whole units (rows linked through an invoice or a movement),
+    # a unit is kept if it lies entirely before the cutoff of its partition.
+    matches = matches.copy()
+    matches['unit'] = get_match_units(matches)
+    matches = matches.merge(cutoffs, on=PARTITION, how='left')
+    matches['last_date'] = matches[['inv_date', 'mov_date']].max(axis=1)
+    unit_last_date = matches.groupby('unit')['last_date'].transform('max')
+    keep = matches['cutoff'].isna() | (unit_last_date < matches['cutoff'])
+    matches = matches.drop(columns=['unit', 'cutoff', 'last_date'])
+    return matches[keep].reset_index(drop=True), matches[~keep].reset_index(drop=True)
+
+def get_match_units(matches):
+    inv_ids = matches.groupby(['rut', 'inv_number'], observed=True).ngroup().to_numpy()
+    mov_ids = matches.groupby('mov_id').ngroup().to_numpy()
+    n_inv = inv_ids.max() + 1 if len(inv_ids) else 0
+    n_nodes = n_inv + (mov_ids.max() + 1 if len(mov_ids) else 0)
+    graph = coo_matrix((np.ones(len(matches), dtype=np.int8), (inv_ids, n_inv + mov_ids)), shape=(n_nodes, n_nodes))
+    return connected_components(graph, directed=False)[1][inv_ids]
+
+def get_pending_rows(df, kept, dropped, cutoffs, keys, date_column):
+    # Rows of touched partitions from the cutoff on, plus older rows whose match is re-run,
+    # minus the rows already used by kept matches
+    df = df.merge(cutoffs, on=PARTITION, how='inner')
+    df = df.merge(get_key_flags(kept, keys, '_kept'), on=keys, how='left')
+    df = df.merge(get_key_flags(dropped, keys, '_dropped'), on=keys, how='left')
+    pending = df['_kept'].isna() & ((df[date_column] >= df['cutoff']) | df['_dropped'].notna())
+    return df[pending].drop(columns=['cutoff', '_kept', '_dropped']).reset_index(drop=True)
+
+def get_key_flags(matches, keys, flag):
+    return matches[keys].drop_duplicates().assign(**{flag: True})
+
+def read_state():
+    try:
+        matches = pd.read_parquet(os.path.join(PATH, 'Matches.parquet'))
+        inv_rows = pd.read_parquet(os.path.join(PATH, 'Invoice Rows.parquet'))
+        mov_rows = pd.read_parquet(os.path.join(PATH, 'Movement Rows.parquet'))
+    except FileNotFoundError:
+        return None
+    return matches, inv_rows, mov_rows
+
+def save_state(matches, inv_rows, mov_rows):
+    if not os.path.exists(PATH):
+        os.mkdir(PATH)
+    matches.to_parquet(os.path.join(PATH, 'Matches.parquet'), index=False)
+    inv_rows.to_parquet(os.path.join(PATH, 'Invoice Rows.parquet'), index=False)
+    mov_rows.to_parquet(os.path.join(PATH, 'Movement Rows.parquet'), index=False)
+
+if __name__ == '__main__':
+    pd.set_option('display.max_columns', None)
+    main()
@@ -0,0 +1,141 @@
+import os
+import json
+import resource
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter, process_time
+import numpy as np
+import pandas as pd
+
+PATH = "Instrumentation"
+PROFILE = False  # cProfile dump per top-level stage
+TRACE_MEMORY = False  # tracemalloc snapshot per top-level stage
+SUMMED_FIELDS = ['calls', 'wall_time', 'cpu_time', 'input_rows', 'output_rows']
+
+records = []
+active = []
+
+def start_run():
+    records.clear()
+
+def start_worker():
+    # Forked workers inherit the caller's open stages, their records are merged back under them instead
+    records.clear()
+    active.clear()
+
+def get_records():
+    return list(records)
+
+def save_run(name):
+    if not os.path.exists(PATH):
+        os.mkdir(PATH)
+    run = {'run': name, 'saved_at': datetime.now().isoformat(timespec='seconds'), 'stages': records}
+    with open(os.path.join(PATH, f'{name}.json'), 'w') as file:
+        json.dump(run, file, indent=2, default=to_json)
+    return run
+
+@contextmanager
+def stage(name, *inputs, aggregate=False):
+    # Stages nest, their names are the path of open stages. Aggregated stages are meant for
+    # per-partition steps: they skip memory and profiling and are summed into one record per path.
+    record = {'stage': get_stage_path(name), 'calls': 1, 'input_rows': count_rows(inputs), 'output_rows': None}
+    outermost = not active
+    if not aggregate:
+        records.append(record)
+        reset_peak_rss()
+    profiler = start_profile() if outermost and not aggregate else None
+    active.append(record)
+    start, cpu_start = perf_counter(), process_time()
+    try:
+        yield record
+    finally:
+        record['wall_time'] = perf_counter() - start
+        record['cpu_time'] = process_time() - cpu_start
+        active.pop()
+        if aggregate:
+            record['aggregated'] = True
+            add_aggregated_record(record)
+        else:
+            record['peak_rss_mb'] = max(record.get('peak_rss_mb', 0), get_peak_rss())
+            record['peak_child_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        if profiler is not None:
+            stop_profile(profiler, record)
+
+def set_output_rows(record, *outputs):
+    record['output_rows'] = count_rows(outputs)
+
+def set_stats(**stats):
+    # Attaches stats (e.g. solver stats) to the innermost open stage, if any
+    if active:
+        active[-1].update(stats)
+
+def merge_records(worker_records):
+    # Records sent back by a worker process are added under the current stage
+    for record in worker_records:
+        add_aggregated_record(dict(record, stage=get_stage_path(record['stage'])))
+
+def add_aggregated_record(record):
+    for previous in reversed(records):
+        if previous['stage'] == record['stage'] and previous.get('aggregated'):
+            for field in SUMMED_FIELDS:
+                previous[field] = (previous[field] or 0) + (record[field] or 0)
+            return
+    records.append(record)
+
+def get_stage_path(name):
+    return f"{active[-1]['stage']}/{name}" if active else name
+
+def count_rows(values):
+    return sum(len(value) for value in values if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)))
+
+def reset_peak_rss():
+    # Linux resets the peak RSS (VmHWM) when writing 5 to clear_refs, open stages keep the peak so far
+    peak = get_peak_rss()
+    for record in active:
+        record['peak_rss_mb'] = max(record.get('peak_rss_mb', 0), peak)
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+def get_peak_rss():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def start_profile():
+    if TRACE_MEMORY:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    if not PROFILE:
+        return {}
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return {'profiler': profiler}
+
+def stop_profile(profiler, record):
+    if not PROFILE and not TRACE_MEMORY:
+        return
+    if not os.path.exists(PATH):
+        os.mkdir(PATH)
+    file = os.path.join(PATH, record['stage'].replace('/', ' - '))
+    if PROFILE:
+        profiler['profiler'].disable()
+        profiler['profiler'].dump_stats(f'{file}.prof')
+    if TRACE_MEMORY:
+        record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.take_snapshot().dump(f'{file}.tracemalloc')
+
+def to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
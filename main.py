@@ -1,147 +1,218 @@
 import pandas as pd
+import numpy as np
 from time import time
-from recordlinkage.index import SortedNeighbourhood
 from preprocessing import get_preprocessed_invoices_and_movements
 from inv_groups import get_invoice_groups
 from mov_groups import get_movement_groups
-from amount_similarity import get_matches_with_similar_amounts
+from group_helpers import add_single_members, member_columns, map_invoices, map_movements, gather_rows
+from amount_similarity import get_matches_with_similar_amounts, get_pairs_with_similar_amounts
 from ilp import optimize
+from parallel import map_partitions
+from stage_cache import run_stage
+from instrumentation import stage, start_run, save_run, set_output_rows
+from results import save_results, get_result_batches
+from sinks import result_sink
+from spill import write_partitions, optimize_partitions
 import params
 
-def main():
+def main(cache=None, write=None):
+    # write is a sink from sinks.result_sink. Results are streamed to it batch by batch and not kept,
+    # only the number of result rows per invoice is returned then.
     invoices, movements = get_preprocessed_invoices_and_movements()
     # invoices = invoices[invoices['rut'] != 763614220]
     # movements = movements[movements['rut'] != 763614220]
-    return match_with_counterparty_rut(invoices, movements)
-    #match_without_counterparty_rut(invoices, movements)
+    matches = match_with_counterparty_rut(invoices, movements, cache, write)
+    if not params.MATCH_WITHOUT_COUNTERPARTY_RUT:
+        return matches
+    without = match_without_counterparty_rut(invoices, movements, matches, cache, write)
+    return pd.concat([matches, without], ignore_index=True)
 
-def match_with_counterparty_rut(invoices, movements):
+def match_with_counterparty_rut(invoices, movements, cache=None, write=None):
     tiempo = time()
-    invoices = invoices[invoices['counterparty_rut'].isin(movements['counterparty_rut'])]
-    movements = movements[movements['counterparty_rut'].isin(invoices['counterparty_rut'])]
-    inv_num_map = map_invoices(invoices)
-    mov_id_map = map_movements(movements)
-    invoices = get_invoices_and_invoice_groups(invoices)
-    movements = get_movements_and_movement_groups(movements)
-    print("Getting candidates")
-    pair_indexes = get_candidate_pairs(invoices, movements)
-    invoices, movements = get_useful_columns(invoices, movements)
+    start_run()
+    inputs = invoices, movements
+    with stage('inputs', invoices, movements) as record:
+        invoices, movements, inv_num_map, mov_id_map = run_stage(cache, 'inputs', get_mapped_invoices_and_movements,
+                                                                 invoices, movements)
+        set_output_rows(record, invoices, movements)
+    print("Building groups")
+    with stage('groups', invoices, movements) as record:
+        invoices, movements = run_stage(cache, 'groups', get_invoices_and_movements_with_groups, invoices, movements)
+        set_output_rows(record, invoices, movements)
     print("Building candidates")
-    candidates = build_and_filter_candidate_pairs(invoices, movements, pair_indexes)
+    with stage('candidates', invoices, movements) as record:
+        candidates = run_stage(cache, 'candidates', build_candidates, invoices, movements)
+        set_output_rows(record, candidates)
     print("Optimizing candidates")
-    matches = optimize(candidates)
+    with stage('matches', candidates) as record:
+        matches = run_stage(cache, 'matches', optimize_candidates, candidates)
+        set_output_rows(record, matches)
+    with stage('results', matches) as record:
+        results = save_results(matches, inv_num_map, mov_id_map, *inputs, write)
+        set_output_rows(record, results)
+    save_run('match_with_counterparty_rut')
     print("Tiempo total", time()-tiempo)
-    return save_results(matches, inv_num_map, mov_id_map)
-
-def map_invoices(invoices):
-    inv_num_map = {v: i for i, v in enumerate(invoices[['rut', 'inv_number']].drop_duplicates().itertuples(index=False, name=None))}
-    invoices.loc[:, 'inv_number'] = invoices.apply(lambda row: inv_num_map[(row['rut'], row['inv_number'])], axis=1)
-    return inv_num_map    
+    return results
 
-def map_movements(movements):
-    mov_id_map = {v: i for i, v in enumerate(movements['mov_id'].unique())}
-    movements.loc[:, 'mov_id'] = movements['mov_id'].map(lambda x: mov_id_map[x])
-    return mov_id_map
+def get_mapped_invoices_and_movements(invoices, movements):
+    invoices = invoices[invoices['counterparty_rut'].isin(movements['counterparty_rut'])]
+    movements = movements[movements['counterparty_rut'].isin(invoices['counterparty_rut'])]
+    invoices, inv_num_map = map_invoices(invoices)
+    movements, mov_id_map = map_movements(movements)
+    return invoices, movements, inv_num_map, mov_id_map
+
+def get_invoices_and_movements_with_groups(invoices, movements):
+    return (map_partitions(get_partition_invoice_groups, invoices, movements, keep_partition=True),
+            map_partitions(get_partition_movement_groups, invoices, movements, keep_partition=True))
+
+def get_partition_invoice_groups(invoices, movements):
+    with stage('invoice_groups', invoices, aggregate=True) as record:
+        invoices = get_invoices_and_invoice_groups(invoices, movements)
+        set_output_rows(record, invoices)
+    return invoices
+
+def get_partition_movement_groups(invoices, movements):
+    with stage('movement_groups', movements, aggregate=True) as record:
+        movements = get_movements_and_movement_groups(movements, invoices)
+        set_output_rows(record, movements)
+    return movements
+
+def build_candidates(invoices, movements):
+    # Out of core, candidates are spilled to disk per partition and their path is passed on instead
+    if params.OUT_OF_CORE:
+        return write_partitions(get_partition_candidates, invoices, movements)
+    return map_partitions(get_partition_candidates, invoices, movements)
+
+def optimize_candidates(candidates):
+    if params.OUT_OF_CORE:
+        return optimize_partitions(candidates)
+    return optimize(candidates)
+
+def get_partition_candidates(invoices, movements):
+    with stage('get_candidate_pairs', invoices, movements, aggregate=True) as record:
+        pair_indexes = get_candidate_pairs(invoices, movements)
+        set_output_rows(record, pair_indexes[0])
+    invoices, movements = get_useful_columns(invoices, movements)
+    with stage('build_and_filter_candidate_pairs', pair_indexes[0], aggregate=True) as record:
+        candidates = build_and_filter_candidate_pairs(invoices, movements, pair_indexes)
+        set_output_rows(record, candidates)
+    return candidates
 
-def get_invoices_and_invoice_groups(invoices):
+def get_invoices_and_invoice_groups(invoices, movements=None):
     invoices = invoices.copy()
-    groups = get_invoice_groups(invoices)
-    invoices['inv_group_numbers'] = invoices['inv_number'].map(lambda x: [x])
+    groups = get_invoice_groups(invoices, movements)
+    invoices = add_single_members(invoices, 'inv_number', 'inv_member')
     return pd.concat([invoices, groups]).reset_index(drop=True)
 
-def get_movements_and_movement_groups(movements):
+def get_movements_and_movement_groups(movements, invoices=None):
     movements = movements.copy()
-    groups = get_movement_groups(movements)
-    movements['mov_group_ids'] = movements['mov_id'].map(lambda x: [x])
+    groups = get_movement_groups(movements, invoices)
+    movements = add_single_members(movements, 'mov_id', 'mov_member')
     return pd.concat([movements, groups]).reset_index(drop=True)
 
-def get_candidate_pairs(invoices, movements):
-    invoices['amt_bin'] = invoices['inv_amount'] // params.AMOUNT_BIN
-    movements['amt_bin'] = movements['mov_amount'] // params.AMOUNT_BIN
-    inv_groups = invoices.groupby(['amt_bin','rut','counterparty_rut']).groups
-    mov_groups = movements.groupby(['amt_bin','rut','counterparty_rut']).groups
-    common_keys = set(inv_groups.keys()) & set(mov_groups.keys())
-    pairs = []
-
-    for key in common_keys:
-        inv_group = invoices.loc[inv_groups[key]]
-        mov_group = movements.loc[mov_groups[key]]
-        pairs.extend(
-            SortedNeighbourhood(left_on='inv_amount', right_on='mov_amount', window=params.WINDOW_SIZE)
-            .index(inv_group, mov_group)
-        )
-    return pairs
+def get_candidate_pairs(invoices, movements, partition=['rut', 'counterparty_rut']):
+    # Amount range queries over each partition's invoices sorted by amount
+    inv_parts = invoices.groupby(partition, observed=True).indices
+    mov_parts = movements.groupby(partition, observed=True).indices
+    inv_amounts = invoices['inv_amount'].to_numpy(dtype=np.float64)
+    mov_amounts = movements['mov_amount'].to_numpy(dtype=np.float64)
+    inv_indexes, mov_indexes = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for key, inv_index in inv_parts.items():
+        if key not in mov_parts:
+            continue
+        mov_index = mov_parts[key]
+        inv_pos, mov_pos = get_pairs_with_similar_amounts(inv_amounts[inv_index], mov_amounts[mov_index])
+        inv_indexes.append(inv_index[inv_pos])
+        mov_indexes.append(mov_index[mov_pos])
+    return np.concatenate(inv_indexes), np.concatenate(mov_indexes)
+
+def get_candidate_pairs_in_date_window(invoices, movements, partition):
+    # Movements are split in date buckets as wide as the date window, so an invoice's window only reaches
+    # its own bucket and the next one, and amount range queries never span the whole history of a company
+    width = max(params.MAX_MOV_DAYS_BEFORE_INV + params.MAX_MOV_DAYS_AFTER_INV + 1, 1)
+    inv_buckets = (invoices['first_inv_date'].to_numpy() - params.MAX_MOV_DAYS_BEFORE_INV) // width
+    movements = movements[partition + ['mov_amount']].assign(bucket=movements['first_mov_date'].to_numpy() // width)
+    inv_indexes, mov_indexes = [], []
+    for offset in (0, 1):
+        inv_index, mov_index = get_candidate_pairs(invoices[partition + ['inv_amount']].assign(bucket=inv_buckets + offset),
+                                                   movements, partition + ['bucket'])
+        inv_indexes.append(inv_index)
+        mov_indexes.append(mov_index)
+    return np.concatenate(inv_indexes), np.concatenate(mov_indexes)
 
 def get_useful_columns(invoices, movements):
-    invoices = invoices[['rut', 'counterparty_rut', 'inv_amount', 'first_inv_date', 'last_inv_date',
-                         'inv_group_len', 'inv_group_numbers']]
-    movements = movements[['rut', 'counterparty_rut', 'mov_amount', 'first_mov_date', 'last_mov_date',
-                         'mov_group_len', 'mov_group_ids']]
+    invoices = invoices[['inv_amount', 'first_inv_date', 'last_inv_date', 'inv_group_len'] + member_columns('inv_member')]
+    movements = movements[['mov_amount', 'first_mov_date', 'last_mov_date', 'mov_group_len'] + member_columns('mov_member')]
     return invoices, movements
 
 def build_and_filter_candidate_pairs(invoices, movements, indexes):
-    df = pd.DataFrame(indexes, columns=['inv_index','mov_index'])
-    df = pd.merge(df, invoices, left_on='inv_index', right_index=True).drop(columns=['rut', 'counterparty_rut', 'inv_index'])
-    df = pd.merge(df, movements, left_on='mov_index', right_index=True).drop(columns=['mov_index'])
+    df = pd.DataFrame({**gather_rows(invoices, indexes[0]), **gather_rows(movements, indexes[1])})
     df = get_candidates_in_valid_date_range(df)
     df = get_matches_with_similar_amounts(df)
-    return df[[
-        'inv_group_numbers','mov_group_ids',
-        'amount_similarity','date_diff'
-    ]]
+    return df[member_columns('inv_member') + member_columns('mov_member') + ['rel_amount_diff','date_diff']]
 
 def get_candidates_in_valid_date_range(candidates):
-    mov_days_after_inv = (candidates['last_mov_date'] - candidates['first_inv_date']).apply(lambda x: x.days)
-    mov_days_before_inv = (candidates['first_inv_date'] - candidates['first_mov_date']).apply(lambda x: x.days)
-    max_diff = (candidates['last_inv_date'] - candidates['first_mov_date']).apply(lambda x: abs(x.days))
-    candidates['date_diff'] = pd.concat([mov_days_after_inv.abs(), mov_days_before_inv.abs(), max_diff], axis=1).max(axis=1)
+    # Group dates are int32 day ordinals
+    first_inv_date = candidates['first_inv_date'].to_numpy()
+    mov_days_after_inv = candidates['last_mov_date'].to_numpy() - first_inv_date
+    mov_days_before_inv = first_inv_date - candidates['first_mov_date'].to_numpy()
+    max_diff = np.abs(candidates['last_inv_date'].to_numpy() - candidates['first_mov_date'].to_numpy())
+    candidates['date_diff'] = np.maximum(np.maximum(np.abs(mov_days_after_inv), np.abs(mov_days_before_inv)), max_diff)
     return candidates[
         (mov_days_after_inv <= params.MAX_MOV_DAYS_AFTER_INV) &
         (mov_days_before_inv <= params.MAX_MOV_DAYS_BEFORE_INV)
     ]
 
-def save_results(matches, inv_id_map, mov_id_map):
-    invoices, movements = get_preprocessed_invoices_and_movements()
-    res = []
-    inv_map = {v:k for k,v in inv_id_map.items()}
-    mov_map = {v:k for k,v in mov_id_map.items()}
-    for i, row in matches.iterrows():
-        if len(row['inv_group_numbers']) == 1 or len(row['mov_group_ids']) == 1:
-            for inv in row.inv_group_numbers:
-                for mov in row.mov_group_ids:
-                    res.append({'rut':inv_map[inv][0],'inv_number':inv_map[inv][1], 'mov_id':mov_map[mov], 'score':row.score}) #'amount_match':min(mov['mov_amount'], inv['inv_amount']),
-        else:
-            continue
-            group_invs = pd.DataFrame([{'rut': inv_map[inv_id][0], 'inv_number': inv_map[inv_id][1]} for inv_id in row.inv_group_numbers])
-            group_invs = pd.merge(invoices, group_invs, on=["rut", "inv_number"]).sort_values(by="inv_number")
-            group_movs = pd.DataFrame([{'mov_id': mov_map[mov_id]} for mov_id in row.mov_group_ids])
-            group_movs = pd.merge(movements, group_movs, on=["mov_id"]).sort_values(by="mov_date")
-            mov_index = 0
-            #print(group_invs)
-            #print(group_movs)
-            mov_remaining = group_movs.iloc[0]['mov_amount']
-            for _, inv in group_invs.iterrows():
-                inv_remaining = inv['inv_amount']
-                #print("Inv amount:",inv['inv_amount'], "Inv remaining:",inv_remaining, "Mov amount:",group_movs.iloc[mov_index]['mov_amount'], "Mov remaining:", mov_remaining)
-                while inv_remaining > 0 and mov_index < len(group_movs):
-                    alloc = min(inv_remaining, mov_remaining)
-                    res.append({'rut':inv['rut'], 'inv_number':inv['inv_number'], 'mov_id': group_movs.iloc[mov_index]['mov_id'], 'amount_match': alloc,'score': row['score']})
-                    inv_remaining  -= alloc
-                    mov_remaining  -= alloc
-                    if mov_remaining <= 0:
-                        mov_index += 1
-                        if mov_index < len(group_movs):
-                            mov_remaining = group_movs.iloc[mov_index]['mov_amount']
-
-    matches = pd.DataFrame(res)
-    matches = pd.merge(invoices, matches, on=['rut', 'inv_number'])
-    matches = pd.merge(movements, matches, on=['rut', 'counterparty_rut', 'mov_id'], suffixes=["_",""])
-    return matches
-
-def match_without_counterparty_rut(invoices, movements):
-    pass
+def match_without_counterparty_rut(invoices, movements, matches=None, cache=None, write=None):
+    # Movements without counterparty RUT are looked up by amount range within the date window
+    # across all the open invoices of their company
+    tiempo = time()
+    start_run()
+    invoices, movements, matches, inv_num_map, mov_id_map = run_stage(
+        cache, 'without_counterparty_rut', get_matches_without_counterparty_rut, invoices, movements, matches)
+    with stage('results', matches) as record:
+        results = save_results_without_counterparty_rut(matches, inv_num_map, mov_id_map, invoices, movements, write)
+        set_output_rows(record, results)
+    save_run('match_without_counterparty_rut')
+    print("Tiempo total sin RUT de contraparte", time()-tiempo)
+    return results
+
+def get_matches_without_counterparty_rut(invoices, movements, matches=None):
+    with stage('inputs', invoices, movements) as record:
+        invoices, movements = get_open_invoices_and_movements_without_counterparty_rut(invoices, movements, matches)
+        mapped_invoices, inv_num_map = map_invoices(invoices)
+        mapped_movements, mov_id_map = map_movements(movements)
+        mapped_invoices = add_single_members(mapped_invoices, 'inv_number', 'inv_member')
+        mapped_movements = add_single_members(mapped_movements, 'mov_id', 'mov_member')
+        set_output_rows(record, invoices, movements)
+    with stage('candidates', mapped_invoices, mapped_movements) as record:
+        pair_indexes = get_candidate_pairs_in_date_window(mapped_invoices, mapped_movements, ['rut'])
+        candidates = build_and_filter_candidate_pairs(*get_useful_columns(mapped_invoices, mapped_movements), pair_indexes)
+        set_output_rows(record, candidates)
+    with stage('matches', candidates) as record:
+        matches = optimize(candidates) if len(candidates) else candidates.assign(score=pd.Series(dtype=np.float64))
+        set_output_rows(record, matches)
+    return invoices, movements, matches, inv_num_map, mov_id_map
+
+def get_open_invoices_and_movements_without_counterparty_rut(invoices, movements, matches=None):
+    movements = movements[movements['counterparty_rut'].isna()]
+    if matches is not None and len(matches):
+        matched = pd.MultiIndex.from_frame(matches[['rut', 'inv_number']].astype({'rut': str}))
+        invoices = invoices[~pd.MultiIndex.from_frame(invoices[['rut', 'inv_number']].astype({'rut': str})).isin(matched)]
+    invoices = invoices[invoices['rut'].isin(movements['rut'])]
+    return invoices, movements
+
+def save_results_without_counterparty_rut(matches, inv_id_map, mov_id_map, invoices, movements, write=None):
+    return get_result_batches(matches, inv_id_map, mov_id_map, invoices, movements, join_results_without_counterparty_rut,
+                              write, 'Matches sin RUT de contraparte')
+
+def join_results_without_counterparty_rut(res, invoices, movements):
+    res = pd.merge(invoices, res, on=['rut', 'inv_number'])
+    # The counterparty of the match is the invoice's
+    return pd.merge(movements.drop(columns='counterparty_rut'), res, on=['rut', 'mov_id'], suffixes=["_",""])
 
 
 if __name__ == '__main__':
     pd.set_option('display.max_columns', None)
-    main()
\ No newline at end of file
+    with result_sink('Matches') as write:
+        main(write=write)
\ No newline at end of file
@@ -1,75 +1,144 @@
+import os
 import pandas as pd
+import numpy as np
 import itertools
-import recordlinkage
+from jellyfish import jaro_winkler_similarity
 from preprocessing import get_preprocessed_invoices_and_movements
-from group_helpers import get_movements_without_rut_associated_invoices, get_invoices_without_rut_associated_movements, create_movement_group
+from group_helpers import get_movements_without_rut_associated_invoices, get_invoices_without_rut_associated_movements, create_movement_group, \
+    movement_group_target_range, has_target_in_range
 from params import MAX_GROUP_LEN
+from sinks import result_sink
 
-def get_mov_groups_with_similar_descriptions(movements):
+PATH = "Preprocessing"
+SIMILARITY_CACHE = 'Description Similarities.parquet'
+MAX_PAIR_DAYS = 14
+SIMILARITY_THRESHOLD = 0.95  # Jaro-Winkler
+SUBGROUP_BUDGET = 1000  # groups per first movement
+
+def get_mov_groups_with_similar_descriptions(movements, invoices=None):
     pair_indexes = get_pair_indexes(movements)
     movements = movements.set_index('mov_id')
     mov_pairs = get_similar_movement_pairs(movements, pair_indexes)
-    mov_groups = group_movements(movements, mov_pairs)
+    mov_groups = group_movements(movements, mov_pairs, get_rut_targets(invoices))
     return mov_groups
 
+def get_rut_targets(invoices):
+    if invoices is None:
+        return {}
+    return {rut: np.sort(amounts.to_numpy(dtype=np.float64)) for rut, amounts in invoices.groupby('rut', observed=True)['inv_amount']}
+
 def get_pair_indexes(movements):
-    links = pd.merge(movements, movements, on=["rut", "counterparty_rut"], suffixes=["_left", "_right"])
-    links = links[links["mov_date_left"] <= links["mov_date_right"]]
-    keep = links.apply(lambda x: True if x['mov_date_left'] < x['mov_date_right'] else x['mov_id_left'] < x['mov_id_right'], axis=1)
-    links = links[keep]
-    links["date_diff"] = (links["mov_date_right"]-links["mov_date_left"]).apply(lambda x: x.days)
-    links = links[links["date_diff"] <= 14]
-    pair_indexes = pd.MultiIndex.from_frame(links[['mov_id_left', 'mov_id_right']])
-    return pair_indexes
+    # Movements of the same partition at most MAX_PAIR_DAYS apart, each pair once with the earlier
+    # (date, mov_id) on the left, from a sliding window over the date-sorted partition
+    movements = movements.sort_values(by=['first_mov_date', 'mov_id'], kind='stable')
+    days = movements['first_mov_date'].to_numpy()
+    mov_ids = movements['mov_id'].to_numpy()
+    lefts, rights = [np.empty(0, dtype=mov_ids.dtype)], [np.empty(0, dtype=mov_ids.dtype)]
+    partitions = movements.groupby(['rut', 'counterparty_rut'], observed=True, dropna=False, sort=False).indices
+    for positions in partitions.values():
+        left, right = get_window_pairs(days[positions])
+        lefts.append(mov_ids[positions[left]])
+        rights.append(mov_ids[positions[right]])
+    return pd.MultiIndex.from_arrays([np.concatenate(lefts), np.concatenate(rights)], names=['mov_id_left', 'mov_id_right'])
+
+def get_window_pairs(days):
+    ends = np.searchsorted(days, days + MAX_PAIR_DAYS, side='right')
+    counts = ends - np.arange(1, len(days) + 1)
+    left = np.repeat(np.arange(len(days)), counts)
+    right = left + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return left, right
 
 def get_similar_movement_pairs(movements, pair_indexes):
-    compare = recordlinkage.Compare()
-    compare.string('mov_description', 'mov_description',
-               method='jarowinkler', threshold=0.95, label='description_sim')
-    mov_pairs = compare.compute(pair_indexes, movements)
-    mov_pairs = mov_pairs[mov_pairs['description_sim'] >= 0.90].reset_index().drop(columns="description_sim")
-    return mov_pairs
+    codes, descriptions = pd.factorize(normalize_descriptions(movements['mov_description']))
+    left = codes[movements.index.get_indexer(pair_indexes.get_level_values('mov_id_left'))]
+    right = codes[movements.index.get_indexer(pair_indexes.get_level_values('mov_id_right'))]
+    similarities = get_description_similarities(np.asarray(descriptions, dtype=object), left, right)
+    return pair_indexes[similarities >= SIMILARITY_THRESHOLD].to_frame(index=False)
+
+def normalize_descriptions(descriptions):
+    descriptions = descriptions.astype('string').str.lower().str.replace(r'\s+', ' ', regex=True).str.strip()
+    return descriptions.replace('', pd.NA)
+
+def get_description_similarities(descriptions, left, right):
+    # Similarity is computed once per unique description pair, missing descriptions never match
+    similarities = np.zeros(len(left))
+    valid = (left >= 0) & (right >= 0)
+    keys = np.minimum(left, right)[valid].astype(np.int64) * len(descriptions) + np.maximum(left, right)[valid]
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    similarities[valid] = get_cached_similarities(descriptions[unique_keys // len(descriptions)],
+                                                  descriptions[unique_keys % len(descriptions)])[inverse.reshape(-1)]
+    return similarities
+
+def get_cached_similarities(lefts, rights):
+    # Pairs are stored in lexicographic order, new ones are added to the cache on disk
+    pairs = pd.DataFrame({'description_left': [min(a, b) for a, b in zip(lefts, rights)],
+                          'description_right': [max(a, b) for a, b in zip(lefts, rights)]})
+    cache = read_similarity_cache()
+    pairs = pairs.merge(cache, on=['description_left', 'description_right'], how='left')
+    missing = pairs['similarity'].isna().to_numpy()
+    if missing.any():
+        pairs.loc[missing, 'similarity'] = [jaro_winkler_similarity(a, b) for a, b in
+                                            zip(pairs['description_left'][missing], pairs['description_right'][missing])]
+        save_similarity_cache(pd.concat([cache, pairs[missing]], ignore_index=True))
+    return pairs['similarity'].to_numpy(dtype=np.float64)
+
+def read_similarity_cache():
+    try:
+        return pd.read_parquet(os.path.join(PATH, SIMILARITY_CACHE))
+    except FileNotFoundError:
+        return pd.DataFrame({'description_left': pd.Series(dtype=object), 'description_right': pd.Series(dtype=object),
+                             'similarity': pd.Series(dtype=np.float64)})
+
+def save_similarity_cache(cache):
+    if not os.path.exists(PATH):
+        os.mkdir(PATH)
+    cache.to_parquet(os.path.join(PATH, SIMILARITY_CACHE), index=False)
 
-def group_movements(movements, movement_pairs):
+def group_movements(movements, movement_pairs, targets=None):
+    # Every group is built once, from its earliest movement
     mov_groups = []
-    seen_group_keys = set()
     movement_pairs = pd.merge(movements, movement_pairs, left_on="mov_id", right_on="mov_id_right")
     for first_mov_id, mov_pairs in movement_pairs.groupby('mov_id_left'):
         first_mov = movements.loc[[first_mov_id]].reset_index()
         mov_ids = mov_pairs['mov_id_right'].unique()
         movs = movements.loc[mov_ids].reset_index().sort_values(by="mov_date", ascending=True)
-        groups = get_group_subgroups(first_mov, movs)
-        for group in groups:
-            key = tuple(sorted(m['mov_id'] for m in group))
-            if key not in seen_group_keys:
-                seen_group_keys.add(key)
-                mov_groups.append(create_movement_group(group))
+        rut_targets = targets.get(first_mov['rut'].iloc[0]) if targets else None
+        for group in get_group_subgroups(first_mov, movs, rut_targets):
+            mov_groups.append(create_movement_group(group))
     return pd.DataFrame(mov_groups)
 
-def get_group_subgroups(first_mov, movs):
-    subgroups = []
-    max_group_len = min(MAX_GROUP_LEN, len(movs))
+def get_group_subgroups(first_mov, movs, targets=None, budget=SUBGROUP_BUDGET):
+    # Lazily yields first_mov plus each combination of the similar movements that fits in MAX_GROUP_LEN
+    # consecutive ones, at most budget of them. With targets (sorted invoice amounts of the company) only
+    # groups that can match one are yielded, and a running sum already above every target isn't extended.
     first_mov = first_mov.to_dict('records')
     movs = movs.to_dict('records')
+    return itertools.islice(iter_group_subgroups(first_mov, movs, (), first_mov[0]['mov_amount'], targets), budget)
 
-    for i in range(max(1, len(movs)-max_group_len+1)):
-        max_group_len = min(MAX_GROUP_LEN, len(movs)-i)
-        for length in range(1,max_group_len+1):
-            combs = [list(comb) for comb in itertools.combinations(movs[i:i+max_group_len], length)]
-            full_combs = list(map(lambda x: first_mov + x, combs))
-            subgroups.extend(full_combs)
-    return subgroups
+def iter_group_subgroups(first_mov, movs, combination, amount, targets):
+    start = combination[-1] + 1 if combination else 0
+    end = min(len(movs), combination[0] + MAX_GROUP_LEN) if combination else len(movs)
+    for j in range(start, end):
+        group_amount = amount + movs[j]['mov_amount']
+        low, high = movement_group_target_range(group_amount)
+        if targets is not None and (not len(targets) or low > targets[-1]):
+            continue
+        group = combination + (j,)
+        if targets is None or has_target_in_range(targets, np.array([low]), np.array([high]))[0]:
+            yield first_mov + [movs[k] for k in group]
+        if len(group) < MAX_GROUP_LEN:
+            yield from iter_group_subgroups(first_mov, movs, group, group_amount, targets)
 
 if __name__ == "__main__":
     pd.set_option('display.max_columns', None)
     invoices, movements = get_preprocessed_invoices_and_movements()
     movs = get_movements_without_rut_associated_invoices(invoices, movements)
     invs = get_invoices_without_rut_associated_movements(invoices, movements)
-    mov_groups = get_mov_groups_with_similar_descriptions(movs)
+    mov_groups = get_mov_groups_with_similar_descriptions(movs, invs)
     exact_matches = pd.merge(invs, mov_groups, left_on=["rut", "inv_amount"], right_on=["rut", "mov_amount"])
-    exact_matches['date_diff'] = (exact_matches['mov_date']-exact_matches['inv_date']).apply(lambda x: x.days)
+    exact_matches['date_diff'] = exact_matches['last_mov_date'] - exact_matches['first_inv_date']
     exact_matches = exact_matches[(-14 <= exact_matches['date_diff']) & (exact_matches['date_diff'] <= 90)]
-    with pd.ExcelWriter('descriptions.xlsx') as writer:
-        exact_matches.to_excel(writer, sheet_name="Posibles matches exactos", index=False)
-        mov_groups.to_excel(writer, sheet_name="Posibles agrupaciones", index=False)
-        invs.to_excel(writer, sheet_name="Facturas sin pagos asociables", index=False)
+    with result_sink('descriptions') as write:
+        write("Posibles matches exactos", exact_matches)
+        write("Posibles agrupaciones", mov_groups)
+        write("Facturas sin pagos asociables", invs)
@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import itertools
+from instrumentation import start_worker, get_records, merge_records
+import params
+
+PARTITION = ['rut', 'counterparty_rut']
+WORKERS = os.cpu_count()
+TASKS_PER_WORKER = 4  # small partitions are packed into about this many tasks per worker
+MIN_TASK_COST = 1e6  # invoice x movement pairs, below this a task isn't worth a process round trip
+TASKS_IN_FLIGHT = 2  # per worker, tasks are built and submitted only this far ahead
+EMPTY_KEY = (None, None)
+
+def map_partitions(function, invoices, movements, keep_partition=False, write=None):
+    # Runs function(invoices, movements) on every (rut, counterparty_rut) partition present on both
+    # sides and concatenates the resulting frames. Partitions are scheduled largest first and
+    # travel to and from the workers as dicts of NumPy arrays. With write, each partition's arrays
+    # go to write(key, arrays) as soon as its task is done instead, and nothing is returned.
+    inv_parts = invoices.groupby(PARTITION, observed=True).indices
+    mov_parts = movements.groupby(PARTITION, observed=True).indices
+    keys = [key for key in inv_parts if key in mov_parts]
+    if not keys:
+        # With no partition on both sides the function still runs once on empty ones, for the result columns
+        keys = [EMPTY_KEY]
+        inv_parts, mov_parts = {EMPTY_KEY: np.empty(0, dtype=np.int64)}, {EMPTY_KEY: np.empty(0, dtype=np.int64)}
+    costs = np.array([len(inv_parts[key]) * len(mov_parts[key]) for key in keys], dtype=np.float64)
+    tasks = get_tasks(costs)
+    # Task inputs are only built when the task is submitted
+    inputs = ([(keys[i], to_arrays(invoices.iloc[inv_parts[keys[i]]]), to_arrays(movements.iloc[mov_parts[keys[i]]]))
+               for i in task] for task in tasks)
+    results = iter_task_results(function, get_param_values(), inputs, len(tasks))
+    if write is not None:
+        for task, task_results in results:
+            for i, result in zip(tasks[task], task_results):
+                write(keys[i], result)
+            del task_results
+        return None
+    by_partition = {i: result for task, task_results in results for i, result in zip(tasks[task], task_results)}
+    df = concat_arrays([by_partition[i] for i in range(len(keys))])
+    if keep_partition:
+        add_partition_columns(df, keys, [len(next(iter(by_partition[i].values()), ())) for i in range(len(keys))])
+    return df
+
+def get_tasks(costs):
+    # Largest partitions go first and alone, the tail is packed until a task reaches the target cost
+    if not len(costs):
+        return []
+    target = max(MIN_TASK_COST, costs.sum() / (WORKERS * TASKS_PER_WORKER))
+    tasks, task, task_cost = [], [], 0
+    for i in np.argsort(-costs, kind='stable'):
+        task.append(i)
+        task_cost += costs[i]
+        if task_cost >= target:
+            tasks.append(task)
+            task, task_cost = [], 0
+    if task:
+        tasks.append(task)
+    return tasks
+
+def iter_task_results(function, param_values, inputs, n_tasks):
+    # Yields (task index, task results) as tasks finish. At most TASKS_IN_FLIGHT tasks per worker are
+    # pending at a time and finished futures are dropped, so only those tasks' inputs and results are held.
+    if n_tasks <= 1 or WORKERS == 1:
+        for i, task in enumerate(inputs):
+            yield i, run_task(function, param_values, task)
+        return
+    inputs = enumerate(inputs)
+    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+        futures = {}
+        while True:
+            for i, task in itertools.islice(inputs, WORKERS * TASKS_IN_FLIGHT - len(futures)):
+                futures[executor.submit(run_worker_task, function, param_values, task)] = i
+            task = None
+            if not futures:
+                return
+            done = wait(futures, return_when=FIRST_COMPLETED).done
+            while done:
+                future = done.pop()
+                i = futures.pop(future)
+                task_results, worker_records = future.result()
+                future = None
+                merge_records(worker_records)
+                yield i, task_results
+                task_results = None
+
+def run_worker_task(function, param_values, partitions):
+    # Stage records of the worker go back with the results, to be merged under the caller's stage
+    start_worker()
+    return run_task(function, param_values, partitions), get_records()
+
+def run_task(function, param_values, partitions):
+    set_param_values(param_values)
+    results = []
+    for key, invoices, movements in partitions:
+        invoices = from_arrays(invoices, key)
+        movements = from_arrays(movements, key)
+        results.append(to_arrays(function(invoices, movements), results=True))
+    return results
+
+def to_arrays(df, results=False):
+    # Text columns don't travel: inputs leave them out, results can't have them
+    text = [column for column in df.columns if column not in PARTITION and df[column].dtype == object]
+    if results and text:
+        raise TypeError(f"Partition results can't have object columns: {text}")
+    return {column: df[column].to_numpy() for column in df.columns if column not in PARTITION and column not in text}
+
+def from_arrays(arrays, key):
+    df = pd.DataFrame(arrays)
+    df['rut'], df['counterparty_rut'] = key
+    return df
+
+def concat_arrays(results):
+    if not results:
+        return pd.DataFrame()
+    return pd.DataFrame({column: np.concatenate([result[column] for result in results]) for column in results[0]})
+
+def add_partition_columns(df, keys, lengths):
+    for i, column in enumerate(PARTITION):
+        values = pd.Categorical([key[i] for key in keys])
+        df[column] = pd.Categorical.from_codes(np.repeat(values.codes, lengths), values.categories)
+
+def get_param_values():
+    # Workers may be spawned, so the current params (e.g. set by compare.tune_params) are sent along
+    return {name: value for name, value in vars(params).items() if name.isupper()}
+
+def set_param_values(param_values):
+    for name, value in param_values.items():
+        setattr(params, name, value)
@@ -4,5 +4,7 @@ MAX_MOV_DAYS_BEFORE_INV = 30
 MAX_MOV_DAYS_AFTER_INV = 170
 MAX_REL_AMOUNT_DIFF = 0.002
 GAUSSIAN_SIMILARITY_SCALE = 0.0004
-WINDOW_SIZE = 3
-AMOUNT_BIN = 100000
+TARGET_DRIVEN_GROUPS = False
+OPTIMIZER = 'ilp'
+MATCH_WITHOUT_COUNTERPARTY_RUT = False  # second pass for movements without counterparty RUT
+OUT_OF_CORE = False  # spill candidates to disk per partition (spill.py)
@@ -1,28 +1,34 @@
+import os
 import pandas as pd
 import numpy as np
+import clay_store
 
-def get_clay_preprocessed_data():
-    df = pd.read_csv('Clay.csv')
+CLAY_COLUMNS = {'fecha_movimiento_humana': 'mov_date', 'fecha_emision_obligacion_humana': 'inv_date', 'folio': 'inv_number',
+                'descripción': 'mov_description', 'monto_match': 'match_amount', 'monto_original_movimiento': 'mov_amount'}
+COLUMNS = ['mov_date', 'inv_date', 'inv_number', 'mov_description', 'match_amount', 'mov_amount', 'rut', 'counterparty_rut']
 
-    df = df.dropna(subset=['emisor_obligacion_rut'], axis=0)
-    df['rut'] = (df['emisor_obligacion_rut'].astype(int).astype(str) + df['emisor_obligacion_dv']).astype(str).apply(lambda x: x.lower())
-    df['counterparty_rut'] = (df.apply(
-        lambda x: str(int(x['receptor_obligacion_rut'])) + x['receptor_obligacion_dv'] if not pd.isna(x['receptor_obligacion_rut']) else np.nan, axis=1)).astype(str).apply(lambda x: x.lower())
-    
-    df['descripción'] = df['descripción'].apply(lambda x: x[:30])
-
-    df = df[['fecha_movimiento_humana', 'fecha_emision_obligacion_humana', 'folio',
-            'descripción', 'monto_match', 
-            'monto_original_movimiento', 'rut', 'counterparty_rut']]
+def get_clay_preprocessed_data(ruts=None):
+    # From the local store once it has been synced (clay_store.sync), from Clay.csv otherwise.
+    # ruts limits the matches to those companies.
+    if os.path.exists(clay_store.PATH):
+        df = clay_store.read_matches(ruts)
+    else:
+        df = preprocess_clay_items(pd.read_csv('Clay.csv'))
+        if ruts is not None:
+            df = df[df['rut'].isin([str(rut) for rut in ruts])]
+    df['mov_description'] = df['mov_description'].str[:30]
+    return df[COLUMNS]
 
-    df.columns = ['mov_date', 'inv_date', 'inv_number',
-            'mov_description', 'match_amount', 
-            'mov_amount', 'rut', 'counterparty_rut']
-    
-    return df
+def preprocess_clay_items(df):
+    df = df.dropna(subset=['emisor_obligacion_rut'], axis=0)
+    df['rut'] = (df['emisor_obligacion_rut'].astype(int).astype(str) + df['emisor_obligacion_dv'].astype(str)).str.lower()
+    receptor_rut = df['receptor_obligacion_rut']
+    df['counterparty_rut'] = (receptor_rut.astype('Int64').astype(str) + df['receptor_obligacion_dv'].astype(str)) \
+        .where(receptor_rut.notna(), np.nan).astype(str).str.lower()
+    return df.rename(columns=CLAY_COLUMNS)
 
 if __name__ == '__main__':
     df = get_clay_preprocessed_data()
     print(len(df))
     # with pd.ExcelWriter('Clay.xlsx') as writer:
-    #     df.to_excel(writer, sheet_name="Clay Preprocesado", index=False)
\ No newline at end of file
+    #     df.to_excel(writer, sheet_name="Clay Preprocesado", index=False)
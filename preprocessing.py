@@ -1,44 +1,176 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.dataset as ds
+import hashlib
+import json
 import os
 
 PATH = "Preprocessing"
+RAW_FILES = ['All Invoices', 'All Movements']  # .parquet (a file or a directory of parts) or .csv
+CACHE_FILES = ['Preprocessed Invoices.arrow', 'Preprocessed Movements.arrow']
+CACHE_VERSION = 7  # bump when the preprocessing steps change
+INVOICE_DOCUMENT_TYPES = [35,38,39,41,48,30,32,33,34,43,45,46,101,102,110,901,914]
+DAYS_OF_INVOICES_BEFORE_MOVEMENTS = 90
+RUT_COLUMNS = ['rut', 'counterparty_rut']
+DATE_FORMAT = 'ISO8601'  # fast path, dates in other formats are parsed one distinct value at a time
+TIMEZONE_SUFFIX = r'(\d:\d\d(?::\d\d(?:\.\d+)?)?)\s*(?:UTC|Z|[+-]\d\d(?::?\d\d)?)$'  # dates keep their local day
+# Raw columns that are read and their types, dates are parsed later by set_date_type and ids by set_id_type
+INVOICE_COLUMNS = {'identity': str, 'number': str, 'invoice_date': str, 'total_adjusted_amount': 'float64',
+                   'counterparty_id': str, 'confirmation_status': str, 'document_type': 'Int64', 'issue_type': str}
+MOVEMENT_COLUMNS = {'id': str, 'identity': str, 'post_date': str, 'amount': 'float64', 'description': str,
+                    'counterparty_id': str}
+CHUNK_ROWS = 500000  # raw rows held in memory at a time while reading
+IDENTITIES = None  # companies to read (e.g. ['76134123-5']), all by default. Pushed down into Parquet scans.
 
 def get_preprocessed_invoices_and_movements():
+    fingerprint, raw_stats, raw_digest = get_cache_fingerprint()
+    cached = read_preprocessed_invoices_and_movements(fingerprint)
+    if cached is not None:
+        return cached
+    invoices, movements = read_invoices_and_movements()
+    invoices = preprocess_invoices(invoices)
+    movements = preprocess_movements(movements)
+    save_dates(invoices, movements)
+    invoices = remove_invoices_before_movements(invoices, movements)
+    invoices, movements = set_cache_column_types(invoices), set_cache_column_types(movements)
+    save_preprocessed_invoices_and_movements(invoices, movements, fingerprint, raw_stats, raw_digest)
+    return invoices, movements
+
+def get_cache_fingerprint():
+    # The raw files are only re-hashed when their size or modification time changed
+    raw_stats = get_raw_file_stats()
+    metadata = read_cache_metadata(CACHE_FILES[0])
+    if metadata is not None and json.loads(metadata.get(b'raw_stats', b'null')) == raw_stats:
+        raw_digest = metadata[b'raw_digest'].decode()
+    else:
+        raw_digest = get_raw_files_digest()
+    settings = json.dumps([CACHE_VERSION, INVOICE_DOCUMENT_TYPES, DAYS_OF_INVOICES_BEFORE_MOVEMENTS, IDENTITIES])
+    fingerprint = hashlib.blake2b((raw_digest + settings).encode(), digest_size=16).hexdigest()
+    return fingerprint, raw_stats, raw_digest
+
+def get_raw_file_stats():
+    stats = [os.stat(path) for path in get_raw_paths()]
+    return [[stat.st_size, stat.st_mtime_ns] for stat in stats]
+
+def get_raw_files_digest():
+    digest = hashlib.blake2b(digest_size=16)
+    for path in get_raw_paths():
+        digest.update(os.path.relpath(path, PATH).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def get_raw_files():
+    # Parquet exports take precedence over CSVs, missing files fail on os.stat as CSVs
+    files = []
+    for name in RAW_FILES:
+        candidates = [f'{name}.parquet', name, f'{name}.csv']
+        files.append(next((file for file in candidates if os.path.exists(os.path.join(PATH, file))), candidates[-1]))
+    return files
+
+def get_raw_paths():
+    paths = []
+    for file in get_raw_files():
+        path = os.path.join(PATH, file)
+        if os.path.isdir(path):
+            paths.extend(sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names))
+        else:
+            paths.append(path)
+    return paths
+
+def read_cache_metadata(file):
     try:
-        return read_preprocessed_invoices_and_movements()
-    except FileNotFoundError:
-        invoices, movements = read_invoices_and_movements()
-        invoices, movements = get_valid_invoices_and_movements(invoices, movements)
-        invoices = preprocess_invoices(invoices)
-        movements = preprocess_movements(movements)
-        save_dates(invoices, movements)
-        invoices = remove_invoices_before_movements(invoices, movements)
-        save_preprocessed_invoices_and_movements(invoices, movements)
-        return invoices, movements
-
-def read_preprocessed_invoices_and_movements():
-    invoices = pd.read_csv(os.path.join(PATH, 'Preprocessed Invoices.csv'))
-    movements = pd.read_csv(os.path.join(PATH,'Preprocessed Movements.csv'))
-    return set_invoices_date_type(invoices), set_movements_date_type(movements) 
+        with pa.memory_map(os.path.join(PATH, file)) as source:
+            return pa.ipc.open_file(source).schema.metadata or {}
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return None
 
-def read_invoices_and_movements():
-    invoices = pd.read_csv(os.path.join(PATH,'All Invoices.csv'))
-    movements = pd.read_csv(os.path.join(PATH,'All Movements.csv'))
+def read_preprocessed_invoices_and_movements(fingerprint):
+    for file in CACHE_FILES:
+        metadata = read_cache_metadata(file)
+        if metadata is None or metadata.get(b'fingerprint') != fingerprint.encode():
+            return None
+    # Numeric and datetime columns without nulls stay views of the mapped file
+    invoices, movements = [read_cache_table(file).to_pandas(split_blocks=True, self_destruct=True) for file in CACHE_FILES]
     return invoices, movements
 
-def get_valid_invoices_and_movements(invoices, movements):
-    invoices = get_valid_invoices(invoices)
-    invoices = get_invoice_sales(invoices)
-    movements = get_movement_sales(movements)
-    return invoices, movements
+def read_cache_table(file):
+    # Uncompressed Arrow IPC, so other processes can map the same file without copying it
+    return feather.read_table(os.path.join(PATH, file), memory_map=True)
+
+def set_cache_column_types(df):
+    df = df.reset_index(drop=True)
+    df[RUT_COLUMNS] = df[RUT_COLUMNS].astype('category')
+    return df
+
+def read_invoices_and_movements():
+    # Only the used columns are read, and invalid rows are dropped chunk by chunk as they are read
+    invoices_file, movements_file = get_raw_files()
+    invoices = read_raw_file(invoices_file, INVOICE_COLUMNS, get_valid_invoice_rows)
+    movements = read_raw_file(movements_file, MOVEMENT_COLUMNS, get_valid_movement_rows)
+    return set_id_type(invoices, 'number'), set_id_type(movements, 'id')
+
+def read_raw_file(file, columns, get_valid_rows):
+    path = os.path.join(PATH, file)
+    if file.endswith('.csv'):
+        chunks = pd.read_csv(path, usecols=list(columns), dtype=columns, chunksize=CHUNK_ROWS)
+    else:
+        chunks = read_parquet_chunks(path, columns)
+    chunks = [get_valid_rows(get_identity_rows(chunk)) for chunk in chunks]
+    if not chunks:
+        return get_valid_rows(set_column_types(pd.DataFrame(columns=list(columns)), columns))
+    return pd.concat(chunks, ignore_index=True)
+
+def read_parquet_chunks(path, columns):
+    # Exports of the queries.sql tables, only the listed identities are scanned
+    dataset = ds.dataset(path, format='parquet')
+    filter = ds.field('identity').isin(IDENTITIES) if IDENTITIES is not None else None
+    for batch in dataset.to_batches(columns=list(columns), filter=filter, batch_size=CHUNK_ROWS):
+        yield set_column_types(batch.to_pandas(), columns)
+
+def set_column_types(df, columns):
+    # Same types as the CSV reader, text columns keep missing values missing
+    for column, dtype in columns.items():
+        if dtype is str:
+            df[column] = df[column].astype(str).where(df[column].notna())
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+def get_identity_rows(df):
+    if IDENTITIES is None:
+        return df
+    return df[df['identity'].isin(IDENTITIES)]
+
+def get_valid_invoice_rows(df):
+    return select_invoice_columns(get_rows_with_valid_ids(get_invoice_sales(get_valid_invoices(df)), 'number'))
+
+def get_valid_movement_rows(df):
+    return select_movement_columns(get_rows_with_valid_ids(get_movement_sales(df), 'id'))
+
+def get_rows_with_valid_ids(df, column):
+    # Rows without an id can't be told apart from each other and are dropped, ids stay text until set_id_type
+    valid = (df[column].notna() & (df[column].str.strip() != '')).to_numpy()
+    if not valid.all():
+        print(f"{(~valid).sum()} filas descartadas por {column} vacío")
+    return df[valid]
+
+def set_id_type(df, column):
+    # Integer ids are parsed from their text, so ids above 2**53 keep every digit.
+    # If any id isn't an integer the whole column stays text.
+    ids = df[column].str.strip()
+    if ids.str.fullmatch(r'\d{1,18}').all():
+        return df.assign(**{column: ids.astype(np.int64)})
+    return df.assign(**{column: ids})
 
 def get_valid_invoices(df):
     accepted_invoices = df[(df['confirmation_status'] != 'R') & 
                            (df['total_adjusted_amount'] > 0)]
-    invoice_document_types = [35,38,39,41,48,30,32,33,34,43,45,46,101,102,110,901,914]
     accepted_invoices_with_valid_types = accepted_invoices[
-        (accepted_invoices['document_type'].isin(invoice_document_types))
+        (accepted_invoices['document_type'].isin(INVOICE_DOCUMENT_TYPES))
     ]
     return accepted_invoices_with_valid_types
 
@@ -67,25 +199,29 @@ def preprocess_movements(movements):
     return movements
 
 def save_dates(invoices, movements):
-    min_mov_dates = movements.groupby('rut').min().reset_index()[['rut', 'mov_date']]
-    min_inv_dates = invoices.groupby('rut').min().reset_index()[['rut', 'inv_date']]
+    min_mov_dates = movements.groupby('rut')['mov_date'].min().reset_index()
+    min_inv_dates = invoices.groupby('rut')['inv_date'].min().reset_index()
     new_invs = remove_invoices_before_movements(invoices, movements)
-    new_inv_dates = new_invs.groupby('rut').min().reset_index()[['rut', 'inv_date']]
+    new_inv_dates = new_invs.groupby('rut')['inv_date'].min().reset_index()
     dates = pd.merge(new_inv_dates, pd.merge(min_mov_dates, min_inv_dates, on="rut"), on="rut")
     dates = dates[['rut', 'mov_date', 'inv_date_y', 'inv_date_x']]
     dates.columns = ['RUT', 'Primer movimiento registrado', 'Primera factura registrada','Primera factura utilizada']
     dates.to_csv("Dates.csv", index=False)
 
 def remove_invoices_before_movements(invoices, movements):
-    earliest_movements = movements.groupby('rut').min().reset_index()[['rut', 'mov_date']]
-    earliest_movements['mov_date'] = earliest_movements['mov_date'] - pd.Timedelta(days=90)
+    earliest_movements = movements.groupby('rut')['mov_date'].min().reset_index()
+    earliest_movements['mov_date'] = earliest_movements['mov_date'] - pd.Timedelta(days=DAYS_OF_INVOICES_BEFORE_MOVEMENTS)
     invoices = invoices.merge(earliest_movements, on='rut')
     invoices = invoices[invoices['inv_date'] >= invoices['mov_date']].drop(columns='mov_date')
     return invoices
 
-def save_preprocessed_invoices_and_movements(invoices, movements):
-    invoices.to_csv(os.path.join(PATH, 'Preprocessed Invoices.csv'), index=False)
-    movements.to_csv(os.path.join(PATH, 'Preprocessed Movements.csv'), index=False)
+def save_preprocessed_invoices_and_movements(invoices, movements, fingerprint, raw_stats, raw_digest):
+    metadata = {b'fingerprint': fingerprint.encode(), b'raw_stats': json.dumps(raw_stats).encode(),
+                b'raw_digest': raw_digest.encode()}
+    for df, file in zip([invoices, movements], CACHE_FILES):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+        feather.write_feather(table, os.path.join(PATH, file), compression='uncompressed')
 
 def select_invoice_columns(df):
     return df[['identity', 'number', 'invoice_date', 'total_adjusted_amount', 'counterparty_id']]
@@ -94,37 +230,42 @@ def rename_invoice_columns(df):
     return df.rename(columns={'identity': 'rut', 'number': 'inv_number', 'total_adjusted_amount': 'inv_amount',
                               'counterparty_id': 'counterparty_rut', 'invoice_date':'inv_date'})
 
-def set_invoices_date_type(invoices):
-    invoices = set_date_type(invoices, ['inv_date'])
-    invoices =  set_date_type(invoices, ['first_inv_date'])
-    return  set_date_type(invoices, ['last_inv_date'])
+def set_date_type(df, columns):
+    df = df.copy()
+    for column in columns:
+        text = df[column].astype(str).where(df[column].notna()).str.replace(TIMEZONE_SUFFIX, r'\1', regex=True)
+        dates = pd.to_datetime(text, format=DATE_FORMAT, errors='coerce')
+        failed = (dates.isna() & text.notna()).to_numpy()
+        if failed.any():
+            dates[failed] = text[failed].map({value: parse_date(value) for value in text[failed].unique()})
+        df[column] = dates.dt.normalize()
+    invalid = df[columns].isna().any(axis=1).to_numpy()
+    if invalid.any():
+        print(f"{invalid.sum()} filas descartadas por {', '.join(columns)} inválido")
+    return df[~invalid]
 
-def set_movements_date_type(movements):
-    movements = set_date_type(movements, ['mov_date'])
-    movements =  set_date_type(movements, ['first_mov_date'])
-    return  set_date_type(movements, ['last_mov_date'])
-
-def set_date_type(df, col):
-    df[col] = df[col].apply(lambda x: pd.to_datetime(x, errors='coerce'))
-    df = df.dropna(subset=col)
-    df[col] = df[col].apply(lambda x: x.dt.date)
-    return df
+def parse_date(value):
+    # Same inference the baseline used for every value (e.g. '05/01/2023')
+    date = pd.to_datetime(value, errors='coerce')
+    return date.tz_localize(None) if date is not pd.NaT and date.tzinfo is not None else date
 
 def add_invoice_group_columns(invoices):
     invoices['is_inv_group'] = False
     invoices['inv_group_len'] = 1
-    invoices['first_inv_date'] = invoices['inv_date']
-    invoices['last_inv_date'] = invoices['inv_date']
+    invoices['first_inv_date'] = get_day_ordinals(invoices['inv_date'])
+    invoices['last_inv_date'] = invoices['first_inv_date']
     #invoices['inv_group_numbers'] = np.nan
 
+def get_day_ordinals(dates):
+    # Group date columns are int32 days since 1970-01-01, so date windows are plain integer comparisons
+    return dates.to_numpy(dtype='datetime64[D]').astype(np.int32)
+
 def format_rut(df, columns):
-    df[columns] = df[columns].apply(remove_dash_from_rut)
-    df[columns] = df[columns].apply(lambda x: x.astype(str).str.lower())
+    # Missing RUTs stay missing instead of becoming 'nan'
+    for column in columns:
+        df[column] = df[column].astype(str).str.replace('-', '', regex=False).str.lower().where(df[column].notna())
     return df
 
-def remove_dash_from_rut(rut):
-    return rut.astype(str).str.replace('-', '')
-
 def select_movement_columns(df):
     return df[['id', 'identity', 'post_date', 'amount', 'description', 'counterparty_id']]
 
@@ -138,8 +279,8 @@ def remove_transfers_between_accounts(df):
 def add_movement_group_columns(movements):
     movements['is_mov_group'] = False
     movements['mov_group_len'] = 1
-    movements['first_mov_date'] = movements['mov_date']
-    movements['last_mov_date'] = movements['mov_date']
+    movements['first_mov_date'] = get_day_ordinals(movements['mov_date'])
+    movements['last_mov_date'] = movements['first_mov_date']
     #movements['mov_group_ids'] = np.nan
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+import pandas as pd
+import numpy as np
+from group_helpers import get_members
+
+RESULT_BATCH = 100000  # matches expanded, joined and written at a time
+
+def save_results(matches, inv_id_map, mov_id_map, invoices, movements, write=None):
+    # invoices and movements are the frames the run started from
+    return get_result_batches(matches, inv_id_map, mov_id_map, invoices, movements, join_results, write, 'Matches')
+
+def join_results(res, invoices, movements):
+    res = pd.merge(invoices, res, on=['rut', 'inv_number'])
+    return pd.merge(movements, res, on=['rut', 'counterparty_rut', 'mov_id'], suffixes=["_",""])
+
+def get_result_batches(matches, inv_id_map, mov_id_map, invoices, movements, join, write, sheet):
+    # Matches are expanded and joined RESULT_BATCH at a time. Without a sink the batches are concatenated,
+    # with one each batch is written once it's ready and only its rows per invoice are kept.
+    lookups = get_result_lookups(inv_id_map, mov_id_map, invoices, movements)
+    batches = []
+    for start in range(0, max(len(matches), 1), RESULT_BATCH):
+        res = get_result_pairs(matches.iloc[start:start + RESULT_BATCH], inv_id_map, mov_id_map, lookups)
+        res = join(res, invoices, movements)
+        if write is not None:
+            write(sheet, res)
+            res = res.groupby(['rut', 'inv_number'], observed=True).size().rename('rows').reset_index()
+        batches.append(res)
+    res = pd.concat(batches, ignore_index=True)
+    if write is not None:
+        res = res.groupby(['rut', 'inv_number'], observed=True)['rows'].sum().reset_index()
+    return res
+
+def get_result_lookups(inv_id_map, mov_id_map, invoices, movements):
+    # Amounts and FIFO order of every mapped invoice and movement, in id order
+    inv_amounts, inv_dates, inv_numbers = get_id_values(invoices, inv_id_map, ['rut', 'inv_number'],
+                                                        ['inv_amount', 'inv_date', 'inv_number'])
+    mov_amounts, mov_dates = get_id_values(movements, pd.DataFrame({'mov_id': mov_id_map}), ['mov_id'], ['mov_amount', 'mov_date'])
+    return inv_amounts, get_invoice_order(inv_dates, inv_numbers), mov_amounts, mov_dates.astype(np.int64)
+
+def get_invoice_order(inv_dates, inv_numbers):
+    # Rank of each invoice by date, invoices of the same day by number
+    order = np.empty(len(inv_dates), dtype=np.int64)
+    order[np.lexsort((inv_numbers, inv_dates))] = np.arange(len(inv_dates))
+    return order
+
+def get_result_pairs(matches, inv_id_map, mov_id_map, lookups):
+    # One row per (invoice, movement) of each match. When either side is a single row every pair is kept,
+    # many-to-many groups are allocated FIFO: invoices by date (then number) against movements by date.
+    inv_amounts, inv_order, mov_amounts, mov_dates = lookups
+    inv_members = get_members(matches, 'inv_member')
+    mov_members = get_members(matches, 'mov_member')
+    many_to_many = ((inv_members >= 0).sum(axis=1) > 1) & ((mov_members >= 0).sum(axis=1) > 1)
+    inv_members[many_to_many] = sort_members(inv_members[many_to_many], inv_order)
+    mov_members[many_to_many] = sort_members(mov_members[many_to_many], mov_dates)
+    allocations = get_fifo_allocations(inv_members, mov_members, inv_amounts, mov_amounts)
+    pairs = (inv_members[:, :, None] >= 0) & (mov_members[:, None, :] >= 0)
+    pairs &= ~many_to_many[:, None, None] | (allocations > 0)
+    match_index, inv_index, mov_index = np.nonzero(pairs)
+    inv_ids = inv_members[match_index, inv_index]
+    return pd.DataFrame({
+        'rut': inv_id_map['rut'].to_numpy()[inv_ids],
+        'inv_number': inv_id_map['inv_number'].to_numpy()[inv_ids],
+        'mov_id': np.asarray(mov_id_map)[mov_members[match_index, mov_index]],
+        'amount_match': np.where(many_to_many[match_index], allocations[match_index, inv_index, mov_index], np.nan),
+        'score': matches['score'].to_numpy()[match_index],
+    })
+
+def get_id_values(df, id_map, keys, columns):
+    # Values of the first row of each mapped id, in id order
+    df = df.drop_duplicates(subset=keys)
+    rows = pd.MultiIndex.from_frame(df[keys].astype(str)).get_indexer(pd.MultiIndex.from_frame(id_map[keys].astype(str)))
+    return [df[column].to_numpy()[rows] for column in columns]
+
+def sort_members(members, values):
+    valid = members >= 0
+    order = np.lexsort((np.where(valid, values[np.maximum(members, 0)], 0), ~valid), axis=1)
+    return np.take_along_axis(members, order, axis=1)
+
+def get_fifo_allocations(inv_members, mov_members, inv_amounts, mov_amounts):
+    # Invoice and movement amounts laid end to end, each pair gets the overlap of their intervals
+    inv = np.where(inv_members >= 0, inv_amounts[np.maximum(inv_members, 0)], 0).astype(np.float64)
+    mov = np.where(mov_members >= 0, mov_amounts[np.maximum(mov_members, 0)], 0).astype(np.float64)
+    inv_end, mov_end = inv.cumsum(axis=1), mov.cumsum(axis=1)
+    overlap = (np.minimum(inv_end[:, :, None], mov_end[:, None, :]) -
+               np.maximum((inv_end - inv)[:, :, None], (mov_end - mov)[:, None, :]))
+    return np.maximum(overlap, 0)
@@ -0,0 +1,72 @@
+import os
+import glob
+from contextlib import contextmanager
+import xlsxwriter
+
+FORMAT = 'parquet'  # 'parquet', 'csv' or 'xlsx'
+XLSX_MAX_ROWS = 1048576  # Excel's sheet limit, longer sheets continue in a new one
+
+@contextmanager
+def result_sink(path, format=FORMAT):
+    # Yields write(sheet, df), meant to be called once per batch as batches are produced.
+    # parquet writes a part file per batch under path/<sheet>/, csv appends to path/<sheet>.csv
+    # and xlsx streams rows to path.xlsx with xlsxwriter's constant memory mode.
+    sheets = {}
+    workbook = None
+    if format == 'xlsx':
+        workbook = xlsxwriter.Workbook(f'{path}.xlsx', {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+    elif format in ('parquet', 'csv'):
+        os.makedirs(path, exist_ok=True)
+    else:
+        raise ValueError(f"Unknown result format: {format}")
+
+    def write(sheet, df):
+        state = sheets.setdefault(sheet, {'batches': 0, 'columns': list(df.columns), 'worksheet': None, 'row': 0, 'parts': 0})
+        df = df.reindex(columns=state['columns'])
+        if format == 'parquet':
+            write_parquet(path, sheet, df, state)
+        elif format == 'csv':
+            write_csv(path, sheet, df, state)
+        else:
+            write_xlsx(workbook, sheet, df, state)
+        state['batches'] += 1
+
+    try:
+        yield write
+    finally:
+        if workbook is not None:
+            workbook.close()
+
+def write_parquet(path, sheet, df, state):
+    directory = os.path.join(path, sheet)
+    if not state['batches']:
+        # Parts left by a previous run would be read as part of this one
+        os.makedirs(directory, exist_ok=True)
+        for file in glob.glob(os.path.join(directory, 'part-*.parquet')):
+            os.remove(file)
+    df.to_parquet(os.path.join(directory, f"part-{state['batches']:05d}.parquet"), index=False)
+
+def write_csv(path, sheet, df, state):
+    first = not state['batches']
+    df.to_csv(os.path.join(path, f'{sheet}.csv'), mode='w' if first else 'a', header=first, index=False)
+
+def write_xlsx(workbook, sheet, df, state):
+    if state['worksheet'] is None:
+        add_worksheet(workbook, sheet, state)
+    for values in get_xlsx_rows(df):
+        if state['row'] == XLSX_MAX_ROWS:
+            add_worksheet(workbook, sheet, state)
+        state['worksheet'].write_row(state['row'], 0, values)
+        state['row'] += 1
+
+def add_worksheet(workbook, sheet, state):
+    state['parts'] += 1
+    name = sheet if state['parts'] == 1 else f"{sheet[:25]} ({state['parts']})"
+    state['worksheet'] = workbook.add_worksheet(name[:31])
+    state['worksheet'].write_row(0, 0, state['columns'])
+    state['row'] = 1
+
+def get_xlsx_rows(df):
+    # Missing values are written as empty cells
+    df = df.astype(object)
+    return df.where(df.notna(), None).itertuples(index=False, name=None)
@@ -0,0 +1,66 @@
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from parallel import map_partitions
+from ilp import optimize
+from group_helpers import member_columns
+from instrumentation import stage, set_stats, set_output_rows
+
+PATH = "Candidates"
+MEMORY_BUDGET = 2 * 2**30  # bytes of candidates read back and optimized at a time
+
+def write_partitions(function, invoices, movements, path=PATH):
+    # Out of core map_partitions: each partition's candidates are written as soon as its task is done,
+    # to path/rut=<rut>/counterparty_rut=<counterparty_rut>/, so only running tasks are held in memory
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    written = {'rows': 0, 'partitions': 0}
+
+    def write(key, arrays):
+        table = pa.table(arrays)
+        if not table.num_rows:
+            return
+        directory = os.path.join(path, f'rut={key[0]}', f'counterparty_rut={key[1]}')
+        os.makedirs(directory, exist_ok=True)
+        pq.write_table(table, os.path.join(directory, 'part-0.parquet'))
+        written['rows'] += table.num_rows
+        written['partitions'] += 1
+
+    map_partitions(function, invoices, movements, write=write)
+    set_stats(spilled_rows=written['rows'], spilled_partitions=written['partitions'])
+    return path
+
+def optimize_partitions(path=PATH):
+    # Partitions share no invoices or movements, so they are optimized a chunk at a time,
+    # as many partitions as fit in MEMORY_BUDGET
+    matches = []
+    for files in get_partition_chunks(path):
+        candidates = ds.dataset(files, format='parquet').to_table().to_pandas()
+        with stage('partition_chunk', candidates, aggregate=True) as record:
+            matches.append(optimize(candidates))
+            set_output_rows(record, matches[-1])
+    if not matches:
+        return pd.DataFrame(columns=member_columns('inv_member') + member_columns('mov_member') +
+                            ['score', 'amount_similarity', 'date_score'])
+    return pd.concat(matches, ignore_index=True)
+
+def get_partition_chunks(path):
+    # Largest partitions come first, one larger than MEMORY_BUDGET makes a chunk on its own
+    files = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names if name.endswith('.parquet')]
+    sizes = {file: get_uncompressed_size(file) for file in files}
+    chunk, chunk_size = [], 0
+    for file in sorted(files, key=lambda file: -sizes[file]):
+        if chunk and chunk_size + sizes[file] > MEMORY_BUDGET:
+            yield chunk
+            chunk, chunk_size = [], 0
+        chunk.append(file)
+        chunk_size += sizes[file]
+    if chunk:
+        yield chunk
+
+def get_uncompressed_size(file):
+    metadata = pq.read_metadata(file)
+    return sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
@@ -0,0 +1,38 @@
+import params
+
+# Params each stage reads directly, a stage is also invalidated when its upstream stage is
+STAGE_PARAMS = {
+    'inputs': [],
+    'groups': ['MAX_GROUP_LEN', 'MAX_GROUP_DATE_DIFF', 'TARGET_DRIVEN_GROUPS'],
+    'candidates': ['MAX_REL_AMOUNT_DIFF', 'MAX_MOV_DAYS_BEFORE_INV', 'MAX_MOV_DAYS_AFTER_INV', 'OUT_OF_CORE'],
+    'matches': ['GAUSSIAN_SIMILARITY_SCALE', 'OPTIMIZER'],
+    'without_counterparty_rut': ['MAX_REL_AMOUNT_DIFF', 'MAX_MOV_DAYS_BEFORE_INV', 'MAX_MOV_DAYS_AFTER_INV',
+                                 'GAUSSIAN_SIMILARITY_SCALE', 'OPTIMIZER'],
+}
+STAGE_UPSTREAM = {'inputs': None, 'groups': 'inputs', 'candidates': 'groups', 'matches': 'candidates',
+                  'without_counterparty_rut': 'matches'}
+
+def run_stage(cache, stage, function, *args):
+    # cache is a plain dict holding the last result of each stage for one dataset
+    if cache is None:
+        return function(*args)
+    key = get_stage_key(stage)
+    if stage in cache and cache[stage][0] == key:
+        return cache[stage][1]
+    result = function(*args)
+    cache[stage] = (key, result)
+    return result
+
+def get_stage_key(stage):
+    values = tuple(getattr(params, name) for name in get_stage_params(stage))
+    upstream = STAGE_UPSTREAM[stage]
+    return values if upstream is None else (values, get_stage_key(upstream))
+
+def get_stage_params(stage):
+    if stage == 'groups' and params.TARGET_DRIVEN_GROUPS:
+        return STAGE_PARAMS[stage] + ['MAX_REL_AMOUNT_DIFF']
+    return STAGE_PARAMS[stage]
+
+def get_stage_order_key(cfg):
+    # Sorting a grid with this key makes the expensive stages change as rarely as possible
+    return tuple(str(cfg.get(name)) for stage in STAGE_PARAMS for name in STAGE_PARAMS[stage])
@@ -0,0 +1,123 @@
+import os
+import numpy as np
+import pandas as pd
+
+PATH = "Synthetic"
+# Share of invoices per payment pattern
+PATTERNS = {'exact': 0.45, 'noisy': 0.15, 'split': 0.1, 'grouped': 0.1, 'missing_counterparty': 0.05, 'unpaid': 0.15}
+AMOUNT_NOISE = 0.0015  # relative, kept inside the default MAX_REL_AMOUNT_DIFF
+MAX_PAYMENT_DELAY = 60
+UNRELATED_MOVEMENTS = 0.1  # movements with no invoice, relative to the number of invoices
+
+def main(path=PATH, **kwargs):
+    invoices, movements, truth = generate_invoices_and_movements(**kwargs)
+    save_dataset(path, invoices, movements, truth)
+    return invoices, movements, truth
+
+def generate_invoices_and_movements(n_invoices=10000, n_companies=2, n_counterparties=200, skew=1.0,
+                                    seed=0, start_date='2022-01-01', days=730):
+    # Counterparty sizes follow a Zipf-like law, skew=0 gives uniform sizes
+    rng = np.random.default_rng(seed)
+    companies = np.array([get_rut(76000000 + 1111 * i) for i in range(n_companies)])
+    counterparties = np.array([get_rut(77000000 + 37 * i) for i in range(n_counterparties)])
+    weights = 1 / np.arange(1, n_counterparties + 1) ** skew
+    invoices = pd.DataFrame({
+        'identity': companies[rng.integers(0, n_companies, n_invoices)],
+        'number': np.arange(1000, 1000 + n_invoices),
+        'invoice_date': pd.Timestamp(start_date) + pd.to_timedelta(rng.integers(0, days, n_invoices), unit='D'),
+        'total_adjusted_amount': get_amounts(rng, n_invoices),
+        'counterparty_id': counterparties[rng.choice(n_counterparties, n_invoices, p=weights / weights.sum())],
+        'confirmation_status': 'A',
+        'document_type': 33,
+        'issue_type': 'issued',
+    })
+    patterns = rng.choice(list(PATTERNS), n_invoices, p=list(PATTERNS.values()))
+    movements, truth = get_paid_movements(invoices, patterns, rng)
+    movements.append(get_unrelated_movements(invoices, rng, start_date, days))
+    movements = pd.concat(movements, ignore_index=True)
+    truth = pd.concat(truth, ignore_index=True)
+    # Movement ids are shuffled so they don't follow the invoices
+    mov_ids = rng.permutation(len(movements)) + 1
+    movements.insert(0, 'id', mov_ids)
+    truth['mov_id'] = mov_ids[truth['mov_id'].to_numpy()]
+    invoices['invoice_date'] = invoices['invoice_date'].dt.strftime('%Y-%m-%d')
+    movements['post_date'] = movements['post_date'].dt.strftime('%Y-%m-%d')
+    return invoices, movements.sort_values('id', ignore_index=True), truth
+
+def get_paid_movements(invoices, patterns, rng):
+    # Truth rows point at movements by their position in the concatenated movements
+    movements, truth, n_movements = [], [], 0
+    for pattern in ['exact', 'noisy', 'missing_counterparty']:
+        invs = invoices[patterns == pattern]
+        amounts = invs['total_adjusted_amount'].to_numpy(dtype=np.float64)
+        if pattern == 'noisy':
+            amounts = amounts * (1 + rng.uniform(-AMOUNT_NOISE, AMOUNT_NOISE, len(invs)))
+        counterparties = invs['counterparty_id'].to_numpy() if pattern != 'missing_counterparty' else np.nan
+        movements.append(create_movements(invs['identity'].to_numpy(), invs['invoice_date'].to_numpy() + get_delays(rng, len(invs)),
+                                          np.round(amounts), counterparties, invs['number'].to_numpy(), rng))
+        truth.append(create_truth(invs['identity'].to_numpy(), invs['number'].to_numpy(), n_movements + np.arange(len(invs))))
+        n_movements += len(invs)
+    for _, inv in invoices[patterns == 'split'].iterrows():
+        n_parts = rng.integers(2, 4)
+        amounts = np.round(inv['total_adjusted_amount'] * rng.dirichlet(np.ones(n_parts)))
+        amounts[-1] = inv['total_adjusted_amount'] - amounts[:-1].sum()
+        movements.append(create_movements(inv['identity'], inv['invoice_date'] + get_delays(rng, n_parts), amounts,
+                                          inv['counterparty_id'], inv['number'], rng))
+        truth.append(create_truth(inv['identity'], inv['number'], n_movements + np.arange(n_parts)))
+        n_movements += n_parts
+    grouped = invoices[patterns == 'grouped'].sort_values('invoice_date')
+    for _, invs in grouped.groupby(['identity', 'counterparty_id']):
+        start = 0
+        while start < len(invs):
+            group = invs.iloc[start:start + rng.integers(2, 4)]
+            movements.append(create_movements(group['identity'].iloc[0], group['invoice_date'].max() + get_delays(rng, 1),
+                                              [group['total_adjusted_amount'].sum()], group['counterparty_id'].iloc[0],
+                                              group['number'].iloc[0], rng))
+            truth.append(create_truth(group['identity'].to_numpy(), group['number'].to_numpy(), n_movements))
+            n_movements += 1
+            start += len(group)
+    return movements, truth
+
+def get_unrelated_movements(invoices, rng, start_date, days):
+    n = int(len(invoices) * UNRELATED_MOVEMENTS)
+    sample = rng.integers(0, len(invoices), n)
+    return create_movements(invoices['identity'].to_numpy()[sample],
+                            pd.Timestamp(start_date) + pd.to_timedelta(rng.integers(0, days, n), unit='D'),
+                            get_amounts(rng, n), invoices['counterparty_id'].to_numpy()[sample], None, rng)
+
+def create_movements(identities, dates, amounts, counterparties, numbers, rng):
+    amounts = np.asarray(amounts, dtype=np.int64)
+    movements = pd.DataFrame({'identity': identities, 'post_date': dates, 'amount': amounts,
+                              'counterparty_id': counterparties}, index=np.arange(len(amounts)))
+    # Half of the paid movements mention the invoice number
+    mentions = rng.random(len(amounts)) < 0.5 if numbers is not None else np.zeros(len(amounts), dtype=bool)
+    movements['description'] = np.where(mentions, 'TRANSF FACT ' + pd.Series(numbers, index=movements.index).astype(str),
+                                        'TRANSFERENCIA RECIBIDA')
+    return movements[['identity', 'post_date', 'amount', 'description', 'counterparty_id']]
+
+def create_truth(identities, numbers, mov_positions):
+    return pd.DataFrame({'identity': identities, 'number': numbers, 'mov_id': mov_positions},
+                        index=np.arange(max(np.size(numbers), np.size(mov_positions))))
+
+def get_amounts(rng, n):
+    return np.maximum(1000, np.round(rng.lognormal(13, 1.2, n))).astype(np.int64)
+
+def get_delays(rng, n):
+    return pd.to_timedelta(rng.integers(0, MAX_PAYMENT_DELAY, n), unit='D')
+
+def get_rut(number):
+    # Chilean RUT with its modulo 11 check digit
+    digits = [int(d) for d in reversed(str(number))]
+    total = sum(d * (2 + i % 6) for i, d in enumerate(digits))
+    check = 11 - total % 11
+    return f"{number}-{'0' if check == 11 else 'K' if check == 10 else check}"
+
+def save_dataset(path, invoices, movements, truth):
+    preprocessing_path = os.path.join(path, 'Preprocessing')
+    os.makedirs(preprocessing_path, exist_ok=True)
+    invoices.to_csv(os.path.join(preprocessing_path, 'All Invoices.csv'), index=False)
+    movements.to_csv(os.path.join(preprocessing_path, 'All Movements.csv'), index=False)
+    truth.to_csv(os.path.join(path, 'Ground Truth.csv'), index=False)
+
+if __name__ == '__main__':
+    main()